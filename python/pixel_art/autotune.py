@@ -0,0 +1,187 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from editor import ExtractionSession, _load_image
+
+# Image shared by the parent, attached once per worker process
+_worker_image = None
+_worker_memory = None
+
+
+def _attach_shared_image(name, shape, dtype):
+    """Pool initializer: view the decoded image in shared memory instead of receiving a copy per task"""
+    global _worker_image, _worker_memory
+    _worker_memory = shared_memory.SharedMemory(name=name)
+    _worker_image = np.ndarray(shape, dtype=dtype, buffer=_worker_memory.buf)
+
+
+def separation_score(ratios, grids):
+    """
+    Lattice regularity of candidate grids, without a reference.
+
+    Measures how cleanly the fill ratios of the cells split into the lit and unlit classes of each grid:
+    the between-class variance of the ratios divided by their total variance (Otsu's criterion),
+    1 for a perfect split and 0 when every cell lands in the same class.
+
+    Args:
+        ratios: Fill ratios above each threshold, shape (thresholds, height, width)
+        grids: Candidate grids, shape (thresholds, cell_thresholds, height, width)
+
+    Returns:
+        scores: Array of shape (thresholds, cell_thresholds)
+    """
+    cells = ratios[0].size
+    ratios = ratios[:, None]
+    lit = grids.sum(axis=(2, 3))
+    lit_sum = (ratios * grids).sum(axis=(2, 3))
+    total_sum = ratios.sum(axis=(2, 3))
+    total_var = ratios.var(axis=(2, 3))
+
+    unlit = cells - lit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lit_mean = lit_sum / lit
+        unlit_mean = (total_sum - lit_sum) / unlit
+        scores = lit * unlit / cells ** 2 * (lit_mean - unlit_mean) ** 2 / total_var
+    return np.nan_to_num(scores, nan=0.0, posinf=0.0)
+
+
+def agreement_score(grids, reference):
+    """
+    Ratio of cells agreeing with a reference array, for every candidate grid.
+    Grids and reference are compared from their top-left cell, cells outside one of them count as unlit.
+    """
+    height = max(grids.shape[-2], reference.shape[0])
+    width = max(grids.shape[-1], reference.shape[1])
+    padded = np.zeros(grids.shape[:-2] + (height, width), dtype=bool)
+    padded[..., :grids.shape[-2], :grids.shape[-1]] = grids
+    expected = np.zeros((height, width), dtype=bool)
+    expected[:reference.shape[0], :reference.shape[1]] = reference > 0
+    return (padded == expected).mean(axis=(-2, -1))
+
+
+def _evaluate(purple_boost, block_size, thresholds, cell_thresholds, grid_size, threshold,
+              blob_detection, registration, reference):
+    """
+    Score every threshold and cell_threshold for one purple_boost and block_size, in a worker.
+
+    Returns:
+        registered: Whether the grid was registered, block_size then had no effect
+        results: One candidate per threshold and cell_threshold, see auto_tune
+    """
+    session = ExtractionSession(_worker_image, grid_size=grid_size, threshold=threshold,
+                                purple_boost=purple_boost, blob_detection=blob_detection,
+                                registration=registration, block_size=block_size,
+                                threshold_range=(min(thresholds), max(thresholds)))
+    grids = session.sweep(thresholds, cell_thresholds)
+    if reference is not None:
+        scores = agreement_score(grids, reference)
+    else:
+        scores = separation_score(session.fill_ratios(thresholds), grids)
+
+    results = []
+    for (i, t), (j, c) in itertools.product(enumerate(thresholds), enumerate(cell_thresholds)):
+        results.append({
+            'score': float(scores[i, j]),
+            'params': {'threshold': int(t), 'cell_threshold': float(c),
+                       'purple_boost': purple_boost, 'block_size': block_size},
+            'grid_size': session.grid_size,
+            'lit_cells': int(grids[i, j].sum()),
+        })
+    return session.registered, results
+
+
+def auto_tune(image_path, reference=None, thresholds=range(80, 241, 5),
+              cell_thresholds=(0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5),
+              purple_boosts=(True, False), block_sizes=(15, 25, 35, 51, 75), grid_size=None,
+              threshold=170, cell_threshold=0.15, purple_boost=True, block_size=35, blob_detection=True,
+              registration=True, workers=None):
+    """
+    Search the extraction parameters of an image in parallel.
+
+    Every purple_boost and block_size pair is a task of a process pool; each task locates the grid once and
+    classifies all threshold and cell_threshold combinations through an ExtractionSession. The image is
+    decoded once and shared with the workers through shared memory.
+
+    block_size only serves the grid detection that registration falls back to. With registration, each
+    purple_boost is first tried with a single block_size, and the others are only tried when the grid
+    could not be registered.
+
+    Args:
+        image_path: Path to the input image
+        reference: Optional pixel array (or path to a .npy) the extraction should reproduce. Without it,
+                   candidates are ranked by how cleanly their cells separate into lit and unlit
+        thresholds, cell_thresholds, purple_boosts, block_sizes: Candidate values of each parameter
+        grid_size, blob_detection, registration: Passed to the extraction, see extract_pixel_array
+        threshold, cell_threshold, purple_boost, block_size: Current values, used to break ties (the smallest
+                                                            change wins). threshold also locates the grid
+        workers: Number of worker processes (default: one per CPU)
+
+    Returns:
+        results: Candidates sorted from best to worst, as dicts with score, params, grid_size and lit_cells
+    """
+    if isinstance(reference, str):
+        reference = np.load(reference)
+
+    img = _load_image(image_path)
+    memory = shared_memory.SharedMemory(create=True, size=img.nbytes)
+    try:
+        np.ndarray(img.shape, dtype=img.dtype, buffer=memory.buf)[:] = img
+        thresholds = list(thresholds)
+        cell_thresholds = list(cell_thresholds)
+        block_sizes = list(block_sizes)
+        first_block_size = block_size if block_size in block_sizes else block_sizes[0]
+        if registration:
+            tasks = [(purple_boost, first_block_size) for purple_boost in purple_boosts]
+        else:
+            tasks = list(itertools.product(purple_boosts, block_sizes))
+
+        max_tasks = len(purple_boosts) * len(block_sizes)
+        with ProcessPoolExecutor(max_workers=workers or min(max_tasks, os.cpu_count()),
+                                 initializer=_attach_shared_image,
+                                 initargs=(memory.name, img.shape, img.dtype)) as pool:
+            def submit(tasks):
+                return [(purple_boost, pool.submit(_evaluate, purple_boost, block_size, thresholds,
+                                                   cell_thresholds, grid_size, threshold, blob_detection,
+                                                   registration, reference))
+                        for purple_boost, block_size in tasks]
+
+            results = []
+            fallbacks = []
+            for purple_boost, future in submit(tasks):
+                registered, task_results = future.result()
+                results.extend(task_results)
+                if registration and not registered:
+                    fallbacks.extend((purple_boost, other) for other in block_sizes if other != first_block_size)
+            for _, future in submit(fallbacks):
+                results.extend(future.result()[1])
+    finally:
+        memory.close()
+        memory.unlink()
+
+    def change(result):
+        params = result['params']
+        return (abs(params['threshold'] - threshold) / 255 + abs(params['cell_threshold'] - cell_threshold) +
+                (params['purple_boost'] != purple_boost) + (params['block_size'] != block_size))
+
+    results.sort(key=lambda result: (-result['score'], change(result)))
+    return results
+
+
+def print_results(results, count=10):
+    """Show the best candidates and the editor.py flags to reproduce the best one"""
+    print(f"{'score':>8} {'-t':>4} {'-c':>5} {'purple':>6} {'block':>5} {'grid':>4} {'lit':>6}")
+    for result in results[:count]:
+        params = result['params']
+        print(f"{result['score']:8.4f} {params['threshold']:4d} {params['cell_threshold']:5.2f} "
+              f"{str(params['purple_boost']):>6} {params['block_size']:5d} {result['grid_size']:4d} "
+              f"{result['lit_cells']:6d}")
+
+    best = results[0]['params']
+    flags = f"-t {best['threshold']} -c {best['cell_threshold']} --block-size {best['block_size']}"
+    if not best['purple_boost']:
+        flags += " --no-purple-boost"
+    print(f"Best parameters: {flags}")
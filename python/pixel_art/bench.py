@@ -0,0 +1,208 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+
+from editor import (create_vertical_symmetry, draw_circle_on_array, extract_pixel_array, load_array_from_text,
+                    render_pixel_image)
+
+SIZES = (16, 64, 256, 1024, 4096)
+
+
+def random_array(size, density=0.3, seed=0):
+    """Random binary pixel array of size x size cells"""
+    rng = np.random.default_rng([seed, size])
+    return (rng.random((size, size)) < density).astype(int)
+
+
+def measure(function, min_time=0.5, max_repeats=50):
+    """
+    Time a call of function and measure its peak of traced memory.
+
+    The first call is a warm-up, unless it already took min_time: calls that slow are timed once. Faster
+    calls are repeated until they add up to min_time. The peak memory comes from a separate call under
+    tracemalloc, which sees the allocations of Python and numpy (so of OpenCV outputs) but not the
+    temporary buffers of native code.
+
+    Returns:
+        result: Dict of the median and minimum time in seconds, the number of timed calls and the peak in bytes
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    times = [elapsed]
+    if elapsed < min_time:
+        times = []
+        while sum(times) < min_time and len(times) < max_repeats:
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'time_median': float(np.median(times)),
+        'time_min': float(min(times)),
+        'repeats': len(times),
+        'peak_bytes': int(peak),
+    }
+
+
+def benchmark_cases(sizes=SIZES, max_side=8192, workdir=None):
+    """
+    Generate the benchmark cases, each with its inputs already prepared.
+
+    Renders and extractions are limited to the sizes whose image fits in max_side pixels.
+
+    Yields:
+        name: Unique name of the case, the key used to compare runs
+        params: Parameters of the case
+        function: Call to measure
+    """
+    for size in sizes:
+        pixel_array = random_array(size)
+
+        # Editing helpers, draw_circle_on_array edits in place so it gets a copy
+        yield (f"create_vertical_symmetry/{size}", {'size': size},
+               lambda a=pixel_array, s=size: create_vertical_symmetry(a, s // 2))
+        yield (f"draw_circle_on_array/{size}", {'size': size, 'radius': size // 4},
+               lambda a=pixel_array, s=size: draw_circle_on_array(a.copy(), s // 2, s // 2, s // 4, 1))
+
+        if workdir is not None:
+            text_file = os.path.join(workdir, f"array_{size}.txt")
+            with open(text_file, 'w') as f:
+                f.writelines(''.join('X' if value else '.' for value in row) + '\n' for row in pixel_array)
+            yield (f"load_array_from_text/{size}", {'size': size},
+                   lambda path=text_file: load_array_from_text(path))
+
+        grid_size = 8
+        if size * grid_size <= max_side:
+            for glow_radius in (grid_size // 2, grid_size, grid_size * 2):
+                yield (f"render_pixel_image/{size}/r{glow_radius}",
+                       {'size': size, 'grid_size': grid_size, 'glow_radius': glow_radius},
+                       lambda a=pixel_array, g=grid_size, r=glow_radius: render_pixel_image(
+                           a, grid_size=g, glow_radius=r, as_array=True))
+
+        grid_size = 20
+        if size * grid_size <= max_side:
+            rendered = render_pixel_image(pixel_array, grid_size=grid_size, as_array=True)
+            img = cv2.cvtColor(rendered, cv2.COLOR_RGBA2BGR)
+            for blob_detection in (True, False):
+                for purple_boost in (True, False):
+                    path = 'blob' if blob_detection else 'contour'
+                    boost = 'boost' if purple_boost else 'plain'
+                    yield (f"extract_pixel_array/{size}/{path}/{boost}",
+                           {'size': size, 'grid_size': grid_size, 'blob_detection': blob_detection,
+                            'purple_boost': purple_boost},
+                           lambda b=blob_detection, p=purple_boost, i=img: extract_pixel_array(
+                               i, blob_detection=b, purple_boost=p, registration=False))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=SIZES, name_filter=None, max_side=8192, min_time=0.5):
+    """
+    Run every benchmark case whose name contains name_filter.
+
+    Returns:
+        report: Dict with the environment of the run and the result of every case by name (see measure)
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, params, function in benchmark_cases(sizes, max_side, workdir):
+            if name_filter and name_filter not in name:
+                continue
+            # Extraction prints its progress
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = measure(function, min_time)
+            results[name] = dict(params, **result)
+            print(f"{name:<48} {result['time_median'] * 1000:10.2f} ms {result['peak_bytes'] / 2 ** 20:10.1f} MB")
+    return {
+        'commit': _git_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+
+
+def compare_reports(baseline, current, threshold=0.1):
+    """
+    Compare the cases two reports have in common.
+
+    Returns:
+        rows: (name, time ratio, peak memory ratio) of every common case, current over baseline
+        regressions: Names of the cases whose time or peak memory grew by more than threshold
+    """
+    rows = []
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        time_ratio = result['time_median'] / max(base['time_median'], 1e-9)
+        memory_ratio = result['peak_bytes'] / max(base['peak_bytes'], 1)
+        rows.append((name, time_ratio, memory_ratio))
+        if time_ratio > 1 + threshold or memory_ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the time and peak memory of the pixel art pipeline')
+    parser.add_argument('--output', '-o', default='bench.json', help='Path of the JSON report')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help='Array sizes (e.g. 16,64,256)')
+    parser.add_argument('--filter', '-k', help='Only run the cases whose name contains this')
+    parser.add_argument('--max-side', type=int, default=8192,
+                        help='Largest side in pixels of the images rendered or extracted')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Time each case is repeated for, in seconds')
+    parser.add_argument('--compare', nargs='+', metavar='REPORT',
+                        help='Compare a new run to a baseline report, or two reports (baseline, then current) '
+                             'without running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Growth reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[1]) as f:
+            report = json.load(f)
+    else:
+        report = run_benchmarks(list(map(int, args.sizes.split(','))), args.filter, args.max_side, args.min_time)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f"Report saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        rows, regressions = compare_reports(baseline, report, args.threshold)
+        print(f"Compared to {baseline.get('commit') or args.compare[0]}:")
+        for name, time_ratio, memory_ratio in rows:
+            flag = '  REGRESSION' if name in regressions else ''
+            print(f"{name:<48} time x{time_ratio:.2f}  memory x{memory_ratio:.2f}{flag}")
+        print(f"{len(regressions)} regressions over {args.threshold:.0%} in {len(rows)} cases")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of the content of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessCache:
+    """
+    Content-addressed cache of extraction results on disk, one compressed .npz per entry.
+
+    Entries are keyed by the hash of the input file plus the arguments they depend on, so renaming
+    or touching a file keeps its entries and editing it invalidates them. The least recently used
+    entries are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory="cache", max_bytes=512 * 1024 * 1024):
+        """
+        Args:
+            directory: Where the entries are stored
+            max_bytes: Size the cache is trimmed down to after each new entry
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, path, **params):
+        """Key of the entry of a file for the given arguments"""
+        description = json.dumps({'file': file_digest(path), **params}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Arrays stored under key as a dict, or None. A hit marks the entry as recently used"""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dict of arrays under key, then evict the oldest entries over max_bytes"""
+        path = self._path(key)
+        # Write then rename, so a crash or a concurrent reader never sees a partial entry
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def array_digest(array):
+    """SHA-256 of the content, shape and type of an array"""
+    digest = hashlib.sha256(np.ascontiguousarray(array).tobytes())
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    Memoized render_pixel_image, keyed by the content of the array and every render argument.
+
+    Renders are kept in an in-memory LRU tier of up to memory_bytes, backed by an optional PreprocessCache
+    on disk, so that a texture build repeated with the same arrays and settings costs a hash and a lookup.
+    Cached renders are shared: arrays are returned read-only and PIL images copy themselves when modified.
+    """
+
+    def __init__(self, directory=None, memory_bytes=256 * 1024 * 1024, max_bytes=1024 * 1024 * 1024):
+        """
+        Args:
+            directory: Where the disk tier is stored, None for memory only
+            memory_bytes: Size of the in-memory tier
+            max_bytes: Size of the disk tier
+        """
+        from collections import OrderedDict
+        self.memory_bytes = memory_bytes
+        self.disk = PreprocessCache(directory, max_bytes) if directory else None
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, pixel_array, **render_options):
+        """Key of the render of an array with the given arguments (defaults included)"""
+        import inspect
+        from editor import render_pixel_image
+        arguments = inspect.signature(render_pixel_image).bind(pixel_array, **render_options)
+        arguments.apply_defaults()
+        params = {name: value for name, value in arguments.arguments.items() if name not in ('pixel_array', 'as_array')}
+        description = json.dumps({'array': array_digest(pixel_array), **params}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key):
+        """Cached RGBA render of key, or None"""
+        if key in self._memory:
+            self.hits += 1
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.hits += 1
+                return self._remember(key, entry['rgba'])
+        self.misses += 1
+        return None
+
+    def put(self, key, rgba):
+        """Store an RGBA render in both tiers"""
+        rgba = self._remember(key, rgba)
+        if self.disk is not None:
+            self.disk.put(key, {'rgba': rgba})
+        return rgba
+
+    def _remember(self, key, rgba):
+        rgba.flags.writeable = False
+        if key not in self._memory:
+            self._memory_used += rgba.nbytes
+        self._memory[key] = rgba
+        self._memory.move_to_end(key)
+        while self._memory_used > self.memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+        return rgba
+
+    def render(self, pixel_array, as_array=False, **render_options):
+        """
+        Same as render_pixel_image, from the cache when possible.
+
+        A falloff function cannot be part of a key, so such renders are not cached.
+        """
+        from editor import render_pixel_image
+        from PIL import Image
+        if callable(render_options.get('falloff')):
+            return render_pixel_image(pixel_array, as_array=as_array, **render_options)
+
+        key = self.key(pixel_array, **render_options)
+        rgba = self.get(key)
+        if rgba is None:
+            rgba = self.put(key, render_pixel_image(pixel_array, as_array=True, **render_options))
+        return rgba if as_array else Image.fromarray(rgba, 'RGBA')
@@ -1,79 +1,693 @@
 import numpy as np
-from PIL import Image, ImageDraw, ImageFilter
+from PIL import Image
 import cv2
 import argparse
 import os
 import pygame
 import pygame.locals
+from scipy import ndimage
+from scipy.fft import next_fast_len, rfft2
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import pdist
 
-def extract_pixel_array(image_path, grid_size=None, threshold=170, cell_threshold=0.15,
-                        purple_boost=True, blob_detection=True, debug_output=False):
+def compute_pixel_scores(img, purple_boost=True):
     """
-    Extract a binary pixel array from an image containing glowing pixels.
+    Compute the per-pixel scores used to classify grid cells, for the whole image at once.
 
     Args:
-        image_path: Path to the input image
-        grid_size: Size of the grid cells (if None, will attempt to detect automatically)
-        threshold: Brightness threshold (0-255) to identify pixels (lower for purple glow)
-        cell_threshold: Minimum ratio of bright pixels in a cell to consider it "on"
-        purple_boost: Enhance purple components for better glow detection
-        blob_detection: Use blob detection for more accurate pixel centers
-        debug_output: Whether to save debug visualization images
+        img: BGR image
+        purple_boost: Combine brightness with a purple score (high in red and blue, low in green)
 
     Returns:
-        pixel_array: Binary numpy array where 1s represent detected pixels
-        grid_size: The grid size used for the array
+        score: Per-pixel score compared to the threshold (float32 with purple boost, else the grayscale image)
+        gray: Grayscale image, used for the bright center test
     """
-    # Load image
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError(f"Could not load image: {image_path}")
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if not purple_boost:
+        return gray, gray
 
-    # Get dimensions
-    height, width = img.shape[:2]
+    # Calculate purple score: high where blue and red are high but green is low
+    b, g, r = cv2.split(img)
+    purple_score = (b.astype(np.float32) + r.astype(np.float32)) / 2 - g.astype(np.float32) * 0.5
+    np.clip(purple_score, 0, 255, out=purple_score)
+
+    # Combine brightness and purple score
+    score = gray.astype(np.float32) * 0.7 + purple_score * 0.3
+    return score, gray
+
+
+def block_view(image, grid_size):
+    """
+    View an image as a (grid_height, grid_size, grid_width, grid_size, ...) array of cells, without copying.
+    Rows and columns that do not fill a whole cell are left out, like in the grid itself.
+    """
+    grid_height = image.shape[0] // grid_size
+    grid_width = image.shape[1] // grid_size
+    cropped = image[:grid_height * grid_size, :grid_width * grid_size]
+    return cropped.reshape((grid_height, grid_size, grid_width, grid_size) + image.shape[2:])
 
-    # Create debug directory if needed
-    if debug_output:
-        os.makedirs("debug", exist_ok=True)
 
-    # Process for better pixel detection
+def classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost=True):
+    """
+    Classify all grid cells at once from the per-pixel scores of compute_pixel_scores.
+
+    A cell is "on" when the ratio of its pixels scoring above threshold exceeds cell_threshold,
+    or, with purple boost, when the center half of the cell is brighter than threshold + 20.
+
+    Returns:
+        grid: Binary numpy array of shape (height // grid_size, width // grid_size)
+    """
+    # Check ratio of high-scoring pixels
+    high_count = np.count_nonzero(block_view(score, grid_size) > threshold, axis=(1, 3))
+    grid = high_count / (grid_size * grid_size) > cell_threshold
+
     if purple_boost:
-        # Split into channels
-        b, g, r = cv2.split(img)
+        # Also check for bright center - strong indicator of a pixel
+        start, end = grid_size // 4, 3 * grid_size // 4
+        if end > start:
+            center_region = block_view(gray, grid_size)[:, start:end, :, start:end]
+            center_brightness = center_region.mean(axis=(1, 3))
+            grid |= center_brightness > threshold + 20
+
+    return grid.astype(int)
+
+
+def compute_cell_colors(img, grid_size, robust=False, white_level=None):
+    """
+    Color of every grid cell at once, through the block view of the image.
+
+    Args:
+        img: BGR image
+        grid_size: Size of the grid cells
+        robust: Per-channel median of the cell instead of its mean, ignores small highlights and dead pixels
+        white_level: Leave out the pixels with every channel at or above this level. A lit pixel often has
+                     a core clipped to white, its color is in the glow around it. Cells with no other pixel
+                     keep the color of all their pixels
+
+    Returns:
+        colors: float32 BGR array of shape (height // grid_size, width // grid_size, 3)
+    """
+    cells = block_view(img, grid_size)
+    if white_level is None:
+        if robust:
+            return np.median(cells, axis=(1, 3)).astype(np.float32)
+        return cells.mean(axis=(1, 3), dtype=np.float32)
+
+    colored = (cells < white_level).any(axis=4, keepdims=True)
+    colored |= ~colored.any(axis=(1, 3), keepdims=True)
+    if robust:
+        return np.nanmedian(np.where(colored, cells, np.nan), axis=(1, 3)).astype(np.float32)
+    return ((cells * colored).sum(axis=(1, 3), dtype=np.float32) /
+            np.count_nonzero(colored, axis=(1, 3)).astype(np.float32))
+
+
+def kmeans_colors(colors, n_colors, iterations=50, seed=0):
+    """
+    Cluster colors into n_colors groups with k-means, vectorized over all the colors at once.
+
+    Clustering happens in Lab space so that distances follow perceived differences. Centers are
+    seeded with k-means++ and an emptied cluster is moved to the color farthest from its center.
+
+    Args:
+        colors: float32 BGR colors (0-255) of shape (N, 3)
+        n_colors: Number of clusters
+        iterations: Maximum number of iterations, stops earlier once no label changes
+        seed: Seed of the k-means++ initialization
+
+    Returns:
+        labels: Cluster index of each color, shape (N,)
+        centers: Mean BGR color of each cluster, shape (n_colors, 3)
+    """
+    rng = np.random.default_rng(seed)
+    lab = cv2.cvtColor(colors.reshape(-1, 1, 3) / 255, cv2.COLOR_BGR2Lab).reshape(-1, 3)
+    n_colors = min(n_colors, len(lab))
+
+    # k-means++ seeding
+    centers = [lab[rng.integers(len(lab))]]
+    closest = ((lab - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, n_colors):
+        total = closest.sum()
+        index = rng.choice(len(lab), p=closest / total) if total > 0 else rng.integers(len(lab))
+        centers.append(lab[index])
+        closest = np.minimum(closest, ((lab - lab[index]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    labels = None
+    for _ in range(iterations):
+        distances = ((lab[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new_labels = np.argmin(distances, axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        counts = np.bincount(labels, minlength=n_colors)
+        sums = np.stack([np.bincount(labels, weights=lab[:, c], minlength=n_colors) for c in range(3)], axis=1)
+        centers = sums / np.maximum(counts, 1)[:, None]
+        for empty in np.flatnonzero(counts == 0):
+            farthest = np.argmax(distances[np.arange(len(lab)), labels])
+            centers[empty] = lab[farthest]
+            labels[farthest] = empty
+
+    # Report the centers as mean BGR colors of their clusters
+    counts = np.bincount(labels, minlength=n_colors)
+    bgr_centers = np.stack([np.bincount(labels, weights=colors[:, c], minlength=n_colors) for c in range(3)], axis=1)
+    return labels, bgr_centers / np.maximum(counts, 1)[:, None]
+
+
+def nearest_neighbour_distances(points):
+    """Distance from each point to its nearest other point, through a KD-tree query"""
+    distances, _ = cKDTree(points).query(points, k=2)
+    return distances[:, 1]
+
+
+def most_common_distance(distances, tolerance=0.1):
+    """
+    Mean of the most populated group of similar distances (within tolerance of each other).
+
+    Distances are binned on a log scale with bins half the tolerance wide, and the densest
+    pair of neighbouring bins is kept, so a group is never split across a bin edge.
+    """
+    distances = distances[distances > 0]
+    bins = np.floor(np.log(distances) / np.log1p(tolerance / 2)).astype(int)
+    bins -= bins.min()
+    counts = np.bincount(bins)
+    if len(counts) > 1:
+        counts = counts[:-1] + counts[1:]
+    best = np.argmax(counts)
+    return np.mean(distances[(bins == best) | (bins == best + 1)])
+
+
+def _spectrum_peak(power, radius, angle, band, max_angle, axis_angle, ring_width):
+    """
+    Find the lattice peak of a power spectrum in the band, within max_angle of axis_angle.
+    Returns (freq_bin_y, freq_bin_x, contrast, share) with sub-bin precision, or None.
+    """
+    mask = band & (np.abs((angle - axis_angle + 90) % 180 - 90) <= max_angle)
+    masked = np.where(mask, power, 0)
+    iy, ix = np.unravel_index(np.argmax(masked), masked.shape)
+    if masked[iy, ix] <= 0:
+        return None
+
+    # A lattice peak is a local maximum, not the edge of a smooth spectrum cut by the band
+    rows = np.arange(iy - 3, iy + 4) % power.shape[0]
+    cols = np.clip(np.arange(ix - 3, ix + 4), 0, power.shape[1] - 1)
+    if power[np.ix_(rows, cols)].max() > power[iy, ix]:
+        return None
+
+    # Compare to the power at the same frequency in every direction, and to the total power
+    ring = np.abs(radius - radius[iy, ix]) <= ring_width
+    contrast = power[iy, ix] / np.median(power[ring])
+    share = power[iy, ix] / power.sum()
+
+    # Sub-bin position from a parabola through the log power
+    def parabola_offset(before, peak, after):
+        curvature = before - 2 * peak + after
+        return 0.5 * (before - after) / curvature if curvature < 0 else 0.0
+
+    log_power = np.log(power[rows[2:5]][:, cols[2:5]] + 1e-12)
+    offset_y = parabola_offset(log_power[0, 1], log_power[1, 1], log_power[2, 1])
+    offset_x = parabola_offset(log_power[1, 0], log_power[1, 1], log_power[1, 2]) if 0 < ix < power.shape[1] - 1 else 0.0
+    return iy + offset_y, ix + offset_x, contrast, share
+
+
+def _lattice_fourier_coefficient(image, frequency):
+    """Fourier coefficient of the image at an arbitrary (fx, fy) frequency, in cycles per pixel"""
+    height, width = image.shape
+    phase_x = -2 * np.pi * frequency[0] * np.arange(width)
+    phase_y = -2 * np.pi * frequency[1] * np.arange(height)
+    rows = image @ np.cos(phase_x).astype(np.float32) + 1j * (image @ np.sin(phase_x).astype(np.float32))
+    return rows, np.exp(1j * phase_y)
+
+
+def _refine_lattice_frequency(image, frequency, iterations=3):
+    """
+    Refine a lattice frequency from the phase slope between the two halves of the image.
+    Returns the refined frequency and the phase of its Fourier coefficient.
+    """
+    height, width = image.shape
+    half_width, half_height = width // 2, height // 2
+
+    # Distance between the weighted centroids of the halves, the phase slope is measured over it
+    col_weights = np.abs(image).sum(axis=0) + 1e-9
+    row_weights = np.abs(image).sum(axis=1) + 1e-9
+    xs, ys = np.arange(width), np.arange(height)
+    spacing_x = (np.average(xs[half_width:], weights=col_weights[half_width:]) -
+                 np.average(xs[:half_width], weights=col_weights[:half_width]))
+    spacing_y = (np.average(ys[half_height:], weights=row_weights[half_height:]) -
+                 np.average(ys[:half_height], weights=row_weights[:half_height]))
+
+    frequency = np.array(frequency, dtype=np.float64)
+    for _ in range(iterations):
+        left, weights_y = _lattice_fourier_coefficient(image[:, :half_width], frequency)
+        right, _ = _lattice_fourier_coefficient(image[:, half_width:], frequency)
+        right *= np.exp(-2j * np.pi * frequency[0] * half_width)
+        rows = left + right
+        frequency[0] += np.angle((weights_y @ right) / (weights_y @ left)) / (2 * np.pi * spacing_x)
+        frequency[1] += np.angle((weights_y[half_height:] @ rows[half_height:]) /
+                                 (weights_y[:half_height] @ rows[:half_height])) / (2 * np.pi * spacing_y)
+
+    rows, weights_y = _lattice_fourier_coefficient(image, frequency)
+    return frequency, np.angle(weights_y @ rows)
+
+
+def register_grid(enhanced, grid_size=None, max_angle=10, min_pitch=4, min_cells=4,
+                  min_contrast=30, min_share=1e-3, edge_slack=0.25):
+    """
+    Register the cell lattice of an image from the power spectrum of its enhanced version, in O(N log N).
+
+    The fundamental peaks of the lattice give the pitch and rotation of the grid, and the phase
+    of the image at these frequencies gives its sub-pixel offset.
+
+    Args:
+        enhanced: Single channel image where the pixels are bright, the sharper the better (locate_grid uses
+                  the fourth power of the brightness, which keeps the pixel cores and not their glow)
+        grid_size: Expected grid size, if known (the search is then limited to +/-15% around it)
+        max_angle: Largest grid rotation to look for, in degrees
+        min_pitch: Smallest grid size to look for, in pixels
+        min_cells: Fewest cells along the shortest side of the image to look for
+        min_contrast: Minimum ratio between a peak and the median power at the same frequency
+        min_share: Minimum ratio between a peak and the total power of the spectrum
+        edge_slack: Fraction of a cell allowed to lie outside the image for that cell to be kept
+                    (along the grid axes, corners of a rotated image are always covered)
+
+    Returns:
+        lattice: Dict with the output 'grid_size', the 'pitch' (x, y) and 'angle' of the grid,
+                 the 'origin' of its first whole cell, its 'shape' in cells and the 2x3 'transform'
+                 mapping aligned pixels to image pixels, or None when no clear lattice is found
+    """
+    height, width = enhanced.shape
+    image = enhanced.astype(np.float32)
+    image -= image.mean()
+
+    # Power spectrum of the windowed image
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    padded_height, padded_width = next_fast_len(height, real=True), next_fast_len(width, real=True)
+    spectrum = rfft2(image * window, s=(padded_height, padded_width), workers=-1)
+    power = spectrum.real ** 2 + spectrum.imag ** 2
+
+    # Frequencies in padded bins (rfft2 only keeps fx >= 0)
+    bins_y = (np.fft.fftfreq(padded_height) * padded_height).astype(np.float32)[:, None]
+    bins_x = np.arange(power.shape[1], dtype=np.float32)[None, :]
+    frequency_y = bins_y / padded_height
+    frequency_x = bins_x / padded_width
+    radius = np.hypot(frequency_x, frequency_y)
+    angle = np.degrees(np.arctan2(frequency_y, frequency_x))
+    pitch = 1 / np.maximum(radius, 1e-9)
+    if grid_size is None:
+        band = (pitch >= min_pitch) & (pitch <= min(height, width) / min_cells)
+    else:
+        band = (pitch >= grid_size * 0.85) & (pitch <= grid_size * 1.15)
+
+    # Fundamental peaks along x and y
+    frequencies = []
+    for axis_angle in (0, 90):
+        peak = _spectrum_peak(power, radius, angle, band, max_angle, axis_angle,
+                              ring_width=1.5 / min(padded_height, padded_width))
+        if peak is None or peak[2] < min_contrast or peak[3] < min_share:
+            frequencies.append(None)
+            continue
+        peak_y, peak_x = peak[:2]
+        if peak_y > padded_height / 2:
+            peak_y -= padded_height
+        frequencies.append(np.array([peak_x / padded_width, peak_y / padded_height]))
+    frequency_x, frequency_y = frequencies
+    if frequency_x is None:
+        return None
+    if frequency_y is None:
+        # Only one clear direction, assume square cells
+        frequency_y = np.array([-frequency_x[1], frequency_x[0]])
+    elif frequency_y[1] < 0:
+        frequency_y = -frequency_y
+
+    frequency_x, phase_x = _refine_lattice_frequency(image, frequency_x)
+    frequency_y, phase_y = _refine_lattice_frequency(image, frequency_y)
+
+    # Cell vectors of the lattice are the columns of the inverse of the frequency matrix
+    frequency_matrix = np.array([frequency_x, frequency_y])
+    cell_vectors = np.linalg.inv(frequency_matrix)
+    pitch_x, pitch_y = np.hypot(*cell_vectors.T)
+    output_size = grid_size or int(round((pitch_x + pitch_y) / 2))
+
+    # Phase (in cells) of the first aligned pixel of a cell, so that pixel centers
+    # are spread evenly around the glow center
+    start = (-np.array([phase_x, phase_y]) / (2 * np.pi) - 0.5 + 0.5 / output_size) % 1
+
+    # Range of cells covering the image, in cell coordinates (cells of a rotated grid may
+    # stick out of the image corners, these parts are left black)
+    corners = np.array([[0, 0], [0, height - 1], [width - 1, 0], [width - 1, height - 1]], dtype=np.float64)
+    cell_coords = corners @ frequency_matrix.T
+    low = cell_coords.min(axis=0)
+    high = cell_coords.max(axis=0)
+    first = np.ceil(low - edge_slack - start).astype(int)
+    last = np.floor(high + edge_slack - start - (output_size - 1) / output_size).astype(int)
+    cols, rows = last - first + 1
+    if cols <= 0 or rows <= 0:
+        return None
+
+    origin = cell_vectors @ (first + start)
+    transform = np.hstack([cell_vectors / output_size, origin[:, None]])
+    return {
+        'grid_size': output_size,
+        'pitch': (pitch_x, pitch_y),
+        'angle': np.degrees(np.arctan2(cell_vectors[1, 0], cell_vectors[0, 0])),
+        'origin': (origin[0], origin[1]),
+        'shape': (rows, cols),
+        'transform': transform,
+    }
+
+
+def align_to_grid(img, lattice):
+    """
+    Resample an image once so that the registered cell lattice is axis-aligned,
+    with cells of lattice['grid_size'] pixels starting at (0, 0).
+    """
+    rows, cols = lattice['shape']
+    grid_size = lattice['grid_size']
+    size = (cols * grid_size, rows * grid_size)
+    transform = lattice['transform']
+
+    # When the lattice is only shifted by whole pixels, copy the pixels instead of interpolating
+    drift = np.abs(transform[:, :2] * grid_size - np.eye(2) * grid_size) @ np.array([cols, rows])
+    if drift.max() < 0.5:
+        shift = np.hstack([np.eye(2), np.round(transform[:, 2:])])
+        return cv2.warpAffine(img, shift, size, flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    return cv2.warpAffine(img, transform, size, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def order_corners(corners):
+    """Order four points as top-left, top-right, bottom-right, bottom-left"""
+    corners = np.asarray(corners, dtype=np.float32).reshape(4, 2)
+    center = corners.mean(axis=0)
+    corners = corners[np.argsort(np.arctan2(corners[:, 1] - center[1], corners[:, 0] - center[0]))]
+    return np.roll(corners, -np.argmin(corners.sum(axis=1)), axis=0)
+
 
-        # Boost purple (high blue and red, low green)
-        enhanced = cv2.addWeighted(b, 0.5, r, 0.5, 0) - g * 0.3
-        enhanced = np.clip(enhanced, 0, 255).astype(np.uint8)
+def _fit_quad(hull):
+    """
+    Four corners simplifying a convex hull, and how well they fit it (intersection over union, 0 without a quad).
+    """
+    # Smallest simplification of the hull that leaves four corners
+    low, high = 0.0, 0.25 * cv2.arcLength(hull, True)
+    quad = None
+    for _ in range(30):
+        epsilon = (low + high) / 2
+        approx = cv2.approxPolyDP(hull, epsilon, True)
+        if len(approx) == 4:
+            quad = approx
+            high = epsilon
+        elif len(approx) > 4:
+            low = epsilon
+        else:
+            high = epsilon
+    if quad is None:
+        return None, 0.0
+
+    quad = quad.astype(np.float32)
+    hull = hull.astype(np.float32)
+    intersection, _ = cv2.intersectConvexConvex(hull, quad)
+    union = cv2.contourArea(hull) + cv2.contourArea(quad) - intersection
+    return quad, intersection / union if union > 0 else 0.0
+
+
+def find_panel_quad(img, purple_boost=True, min_fit=0.95, min_solidity=0.85, min_area=0.05):
+    """
+    Find the quadrilateral of a panel of glowing pixels in a photo taken at an angle.
+
+    The panel body is looked for first: the largest solid region brighter than its surroundings, below
+    the glow level (two Otsu thresholds). Otherwise the convex hull of the glowing pixels is used, which
+    only gives the panel when lit pixels reach its four sides.
+
+    Args:
+        img: BGR image
+        purple_boost: Score pixels like the classifier does
+        min_fit: Minimum overlap (intersection over union) of the quad and the hull it simplifies
+        min_solidity: Minimum ratio of the panel body region to its convex hull
+        min_area: Minimum ratio of the quad to the image, so a single bright pixel is not taken for the panel
+
+    Returns:
+        corners: float32 array of shape (4, 2), ordered like order_corners, or None when no panel is found
+    """
+    score, _ = compute_pixel_scores(img, purple_boost)
+    score = np.clip(score, 0, 255).astype(np.uint8)
+    kernel = np.ones((5, 5), np.uint8)
+    min_quad_area = min_area * img.shape[0] * img.shape[1]
+
+    glow_threshold, glow = cv2.threshold(score, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    below_glow = score[score < glow_threshold]
+    if below_glow.size:
+        body_threshold, _ = cv2.threshold(below_glow, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        body = cv2.morphologyEx((score > body_threshold).astype(np.uint8), cv2.MORPH_CLOSE, kernel)
+        body = cv2.morphologyEx(body, cv2.MORPH_OPEN, kernel)
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(body)
+        if count > 1:
+            largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+            hull = cv2.convexHull(cv2.findNonZero((labels == largest).astype(np.uint8)))
+            solidity = stats[largest, cv2.CC_STAT_AREA] / max(cv2.contourArea(hull), 1)
+            quad, fit = _fit_quad(hull)
+            if solidity >= min_solidity and fit >= min_fit and cv2.contourArea(quad) >= min_quad_area:
+                return order_corners(quad)
+
+    points = cv2.findNonZero(cv2.morphologyEx(glow, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8)))
+    if points is not None:
+        quad, fit = _fit_quad(cv2.convexHull(points))
+        if fit >= min_fit and cv2.contourArea(quad) >= min_quad_area:
+            return order_corners(quad)
+    return None
+
+
+def rectify_panel(img, corners=None, grid_size=None, threshold=170, purple_boost=True, blob_detection=True,
+                  registration=True, debug_output=False, block_size=35):
+    """
+    Undo the perspective of a photographed panel with a single warp of the image.
+
+    The panel quad (found with find_panel_quad when corners is None) is first mapped to a rectangle to
+    locate the grid on the square-on view. The homography and the registered lattice are then combined,
+    and the original image is warped once to cells of exactly grid_size pixels starting at (0, 0).
+
+    Args:
+        img: BGR image
+        corners: Four (x, y) corners of the panel in any order, found automatically when None
+                 (when no panel is found either, the image is only located like in locate_grid)
+        grid_size, threshold, purple_boost, blob_detection, registration, debug_output, block_size:
+            See extract_pixel_array
 
-        if debug_output:
-            cv2.imwrite("debug/enhanced_purple.png", enhanced)
+    Returns:
+        img: The rectified image, a whole number of cells wide and high
+        grid_size: The grid size of the rectified image
+    """
+    corners = find_panel_quad(img, purple_boost) if corners is None else order_corners(corners)
+    if corners is None:
+        print("No panel quadrilateral found, extracting without perspective correction (pass its corners)")
+        return locate_grid(img, grid_size, threshold, purple_boost, blob_detection,
+                           registration, debug_output, block_size)
+    print(f"Panel corners: {', '.join(f'({x:.0f}, {y:.0f})' for x, y in corners)}")
+
+    # Square-on view of the panel at its natural size, with a margin for the cells around the quad
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left))
+    height = max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right))
+    margin = 0.02 * max(width, height) + 2
+    target = np.float32([[margin, margin], [margin + width, margin],
+                         [margin + width, margin + height], [margin, margin + height]])
+    homography = cv2.getPerspectiveTransform(corners, target)
+    view_size = (int(np.ceil(width + 2 * margin)), int(np.ceil(height + 2 * margin)))
+    view = cv2.warpPerspective(img, homography, view_size)
+
+    view, grid_size, lattice = locate_grid(view, grid_size, threshold, purple_boost, blob_detection,
+                                           registration, debug_output, block_size, return_lattice=True)
+    if lattice is None:
+        # The view is already the grid, only its size is an estimate
+        rows, cols = view.shape[0] // grid_size, view.shape[1] // grid_size
+        cells_to_view = np.diag([1.0, 1.0, 1.0])
     else:
-        # Convert to grayscale if not using purple boost
-        enhanced = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        rows, cols = lattice['shape']
+        cells_to_view = np.vstack([lattice['transform'], [0, 0, 1]])
+
+    # Output pixels -> square-on view -> original photo, in one inverse map
+    output_to_image = np.linalg.inv(homography) @ cells_to_view
+    return cv2.warpPerspective(img, output_to_image, (cols * grid_size, rows * grid_size),
+                               flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP), grid_size
 
-    # Apply adaptive thresholding for better handling of gradients
-    block_size = 35  # Size of pixel neighborhood for adaptive thresholding
-    adaptive_threshold = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                               cv2.THRESH_BINARY, block_size, -5)
 
-    # Also apply normal thresholding as a baseline
-    _, normal_threshold = cv2.threshold(enhanced, threshold, 255, cv2.THRESH_BINARY)
+def draw_grid_lattice(img, lattice, color=(0, 0, 255)):
+    """Draw the cell boundaries of a registered lattice on a copy of the image"""
+    lattice_img = img.copy()
+    rows, cols = lattice['shape']
+    grid_size = lattice['grid_size']
+    transform = lattice['transform']
 
-    # Combine both thresholds for robustness
-    combined_threshold = cv2.bitwise_or(adaptive_threshold, normal_threshold)
+    def to_image(u, v):
+        # Cell boundaries lie half an aligned pixel before the first pixel of each cell
+        x, y = transform @ np.array([u * grid_size - 0.5, v * grid_size - 0.5, 1.0])
+        return int(round(x)), int(round(y))
 
-    # Apply morphological operations to clean up the image
-    kernel = np.ones((3, 3), np.uint8)
-    cleaned = cv2.morphologyEx(combined_threshold, cv2.MORPH_OPEN, kernel)
+    for col in range(cols + 1):
+        cv2.line(lattice_img, to_image(col, 0), to_image(col, rows), color, 1)
+    for row in range(rows + 1):
+        cv2.line(lattice_img, to_image(0, row), to_image(cols, row), color, 1)
+    return lattice_img
 
-    if debug_output:
-        cv2.imwrite("debug/adaptive_threshold.png", adaptive_threshold)
-        cv2.imwrite("debug/normal_threshold.png", normal_threshold)
-        cv2.imwrite("debug/combined_threshold.png", combined_threshold)
-        cv2.imwrite("debug/cleaned_threshold.png", cleaned)
+
+class DebugImageWriter:
+    """
+    Write debug images from a background thread pool, so PNG encoding overlaps the extraction.
+
+    Images handed to write() must not be modified afterwards. close() (or leaving a with block)
+    waits until every image is on disk.
+    """
+
+    def __init__(self, directory="debug", workers=2, compression=None, scale=1.0):
+        """
+        Args:
+            directory: Where the images are written
+            workers: Number of writer threads
+            compression: PNG compression level (0-9), None for the OpenCV default, which is usually the fastest
+            scale: Downscale factor of the written previews (1 for full resolution)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.scale = scale
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = []
+
+    def _write(self, path, image):
+        if self.scale != 1:
+            image = cv2.resize(image, None, fx=self.scale, fy=self.scale,
+                               interpolation=cv2.INTER_AREA if self.scale < 1 else cv2.INTER_NEAREST)
+        params = [] if self.compression is None else [cv2.IMWRITE_PNG_COMPRESSION, self.compression]
+        cv2.imwrite(path, image, params)
+
+    def write(self, name, image):
+        """Queue an image to be written as directory/name"""
+        self._pending.append(self._pool.submit(self._write, os.path.join(self.directory, name), image))
+
+    def close(self):
+        """Wait for the queued images and stop the writer threads, raising the first write error"""
+        self._pool.shutdown(wait=True)
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def draw_cell_grid(img, grid, grid_size, on_color=(0, 255, 0), off_color=(0, 0, 255)):
+    """
+    Outline every cell of the grid on a copy of the image, in on_color for lit cells and off_color for the others.
+    """
+    height, width = grid.shape[0] * grid_size, grid.shape[1] * grid_size
+    grid_img = img.copy()
+    colors = np.where(grid[:, :, None] == 1, np.array(on_color, np.uint8), np.array(off_color, np.uint8))
+
+    # Lines between cells are 2 pixels wide, each half in the color of its own cell,
+    # only the first and last row and column of every cell are written
+    column_colors = np.repeat(colors, grid_size, axis=0)
+    row_colors = np.repeat(colors, grid_size, axis=1)
+    grid_img[:height, 0:width:grid_size] = column_colors
+    grid_img[:height, grid_size - 1:width:grid_size] = column_colors
+    grid_img[0:height:grid_size, :width] = row_colors
+    grid_img[grid_size - 1:height:grid_size, :width] = row_colors
+    return grid_img
+
+
+def _debug_writer(debug_output):
+    """Writer for a debug_output argument: None when disabled, a new writer for True, or the caller's own writer"""
+    if isinstance(debug_output, DebugImageWriter):
+        return debug_output
+    return DebugImageWriter() if debug_output else None
+
+
+def _load_image(image):
+    """Load a BGR image from a path, an already decoded BGR array is passed through"""
+    if isinstance(image, np.ndarray):
+        return image
+    img = cv2.imread(image)
+    if img is None:
+        raise ValueError(f"Could not load image: {image}")
+    return img
+
+
+def locate_grid(img, grid_size=None, threshold=170, purple_boost=True, blob_detection=True,
+                registration=True, debug_output=False, block_size=35, return_lattice=False):
+    """
+    Find the cell grid of an image, the part of the extraction that does not depend on cell_threshold.
+
+    Args:
+        img: BGR image
+        grid_size, threshold, purple_boost, blob_detection, registration, debug_output, block_size:
+            See extract_pixel_array
+        return_lattice: Also return the registered lattice, to align other images of the same grid
+
+    Returns:
+        img: The image, resampled so that the cell lattice is axis-aligned and starts at (0, 0) when registered
+        grid_size: The grid size to classify cells with
+        lattice: Result of register_grid, None when the grid was not registered (only with return_lattice)
+    """
+    # Get dimensions
+    height, width = img.shape[:2]
+
+    # Debug images are written in the background while the extraction goes on
+    debug = _debug_writer(debug_output)
+
+    # Process for better pixel detection: score pixels like classify_cells does, so the glow around
+    # the pixels stays below the threshold there too (in a plain purple boost it is as bright as the pixels)
+    score, gray = compute_pixel_scores(img, purple_boost)
+    enhanced = np.clip(score, 0, 255).astype(np.uint8) if purple_boost else gray
+    if debug and purple_boost:
+        debug.write("enhanced_purple.png", enhanced)
+
+    # Register the cell lattice (pitch, offset and rotation) from the spectrum of the brightness to the fourth
+    # power. The glow around the pixels is as strong as their cores in the purple-boosted image, and the power
+    # leaves mostly the cores, whose lattice is sharper than the one of their blurred glows
+    lattice = None
+    if registration:
+        brightness = gray.astype(np.float32) / 255
+        lattice = register_grid(brightness ** 4, grid_size)
+        if lattice is None:
+            print("Grid registration found no clear lattice, falling back to blob detection")
+        else:
+            print(f"Registered grid: pitch {lattice['pitch'][0]:.2f}x{lattice['pitch'][1]:.2f}, "
+                  f"angle {lattice['angle']:.2f} deg, origin ({lattice['origin'][0]:.1f}, {lattice['origin'][1]:.1f})")
+
+            if debug:
+                debug.write("grid_alignment.png", draw_grid_lattice(img, lattice))
+
+            # Resample once so that the cell lattice is axis-aligned and starts at (0, 0)
+            img = align_to_grid(img, lattice)
+            height, width = img.shape[:2]
+            grid_size = lattice['grid_size']
 
     # If grid_size is not provided, try to estimate it
     if grid_size is None:
+        # Apply adaptive thresholding for better handling of gradients
+        adaptive_threshold = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                                   cv2.THRESH_BINARY, block_size, -5)
+
+        # Also apply normal thresholding as a baseline
+        _, normal_threshold = cv2.threshold(enhanced, threshold, 255, cv2.THRESH_BINARY)
+
+        # Combine both thresholds for robustness
+        combined_threshold = cv2.bitwise_or(adaptive_threshold, normal_threshold)
+
+        # Apply morphological operations to clean up the image
+        kernel = np.ones((3, 3), np.uint8)
+        cleaned = cv2.morphologyEx(combined_threshold, cv2.MORPH_OPEN, kernel)
+
+        if debug:
+            debug.write("adaptive_threshold.png", adaptive_threshold)
+            debug.write("normal_threshold.png", normal_threshold)
+            debug.write("combined_threshold.png", combined_threshold)
+            debug.write("cleaned_threshold.png", cleaned)
+
         if blob_detection:
             # Set up the blob detector parameters
             params = cv2.SimpleBlobDetector_Params()
@@ -94,11 +708,11 @@ def extract_pixel_array(image_path, grid_size=None, threshold=170, cell_threshol
             # Detect blobs
             keypoints = detector.detect(inverted)
 
-            if debug_output:
+            if debug:
                 # Draw keypoints on debug image
                 blob_image = cv2.drawKeypoints(img, keypoints, np.array([]), (0, 255, 0),
                                                cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-                cv2.imwrite("debug/blob_detection.png", blob_image)
+                debug.write("blob_detection.png", blob_image)
 
             # Get blob centers
             centers = [(int(k.pt[0]), int(k.pt[1])) for k in keypoints]
@@ -116,223 +730,505 @@ def extract_pixel_array(image_path, grid_size=None, threshold=170, cell_threshol
                     centers.append((cx, cy))
 
         if len(centers) >= 2:
+            points = np.array(centers, dtype=np.float64)
+
             # Use Delaunay triangulation to find most common distances between points
             if len(centers) > 3:
                 try:
-                    # Convert centers to numpy array
-                    points = np.array(centers)
-
                     # Create Delaunay triangulation
                     tri = cv2.Subdiv2D((0, 0, width, height))
-                    for p in points:
-                        tri.insert((float(p[0]), float(p[1])))
-
-                    # Get triangulation edges
-                    edge_list = []
-                    edge_start = []
-
-                    # Get edges from triangulation
-                    for e in range(0, tri.getEdgeCount()):
-                        org_pt = []
-                        dst_pt = []
-                        edge = tri.getEdge(e)
-                        if edge[0]:
-                            org_pt = tri.getVertex(edge[1])
-                            dst_pt = tri.getVertex(edge[2])
-                            edge_start.append(org_pt)
-                            edge_list.append(np.sqrt((org_pt[0] - dst_pt[0]) ** 2 + (org_pt[1] - dst_pt[1]) ** 2))
-
-                    # Find most common distance
-                    edge_list = np.array(edge_list)
+                    tri.insert(points.astype(np.float32))
 
-                    # Group similar distances (within 10% of each other)
-                    edges_sorted = np.sort(edge_list)
-                    groups = []
-                    current_group = [edges_sorted[0]]
+                    # Get triangulation edges, leaving out the ones to the virtual outer vertices
+                    edges = tri.getEdgeList()
+                    inside = ((edges[:, [0, 2]] >= 0) & (edges[:, [0, 2]] < width) &
+                              (edges[:, [1, 3]] >= 0) & (edges[:, [1, 3]] < height)).all(axis=1)
+                    edges = edges[inside]
+                    edge_lengths = np.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1])
 
-                    for i in range(1, len(edges_sorted)):
-                        if edges_sorted[i] < current_group[0] * 1.1:
-                            current_group.append(edges_sorted[i])
-                        else:
-                            groups.append(current_group)
-                            current_group = [edges_sorted[i]]
-
-                    if current_group:
-                        groups.append(current_group)
-
-                    # Find the largest group
-                    largest_group = max(groups, key=len)
-                    grid_size = int(np.mean(largest_group))
+                    # Find most common distance
+                    grid_size = int(most_common_distance(edge_lengths))
 
-                    if debug_output:
+                    if debug:
                         # Draw triangulation on debug image
                         triangulation_img = img.copy()
-                        for e in range(tri.getEdgeCount()):
-                            org_pt = []
-                            dst_pt = []
-                            edge = tri.getEdge(e)
-                            if edge[0]:
-                                org_pt = tri.getVertex(edge[1])
-                                dst_pt = tri.getVertex(edge[2])
-                                org_pt = tuple(map(int, org_pt))
-                                dst_pt = tuple(map(int, dst_pt))
-                                cv2.line(triangulation_img, org_pt, dst_pt, (0, 255, 0), 1)
-                        cv2.imwrite("debug/triangulation.png", triangulation_img)
+                        for x1, y1, x2, y2 in edges.astype(int):
+                            cv2.line(triangulation_img, (int(x1), int(y1)), (int(x2), int(y2)), (0, 255, 0), 1)
+                        debug.write("triangulation.png", triangulation_img)
 
                 except Exception as e:
                     print(f"Triangulation failed: {e}. Falling back to distance calculation.")
-                    # Calculate pairwise distances between centers as fallback
-                    distances = []
-                    for i in range(len(centers)):
-                        nearest_dists = []
-                        for j in range(len(centers)):
-                            if i != j:
-                                x1, y1 = centers[i]
-                                x2, y2 = centers[j]
-                                dist = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-                                nearest_dists.append(dist)
-                        if nearest_dists:
-                            # Use the minimum distance for each center
-                            nearest_dists.sort()
-                            distances.append(nearest_dists[0])
-
-                    if distances:
-                        # Use median of distances to be robust to outliers
-                        grid_size = int(np.median(distances))
+                    # Use the nearest neighbour distance of each center, median to be robust to outliers
+                    grid_size = int(np.median(nearest_neighbour_distances(points)))
             else:
-                # Calculate pairwise distances between centers
-                distances = []
-                for i in range(len(centers)):
-                    for j in range(i + 1, len(centers)):
-                        x1, y1 = centers[i]
-                        x2, y2 = centers[j]
-                        dist = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-                        distances.append(dist)
-
-                if distances:
-                    # Use median of distances to be robust to outliers
-                    grid_size = int(np.median(distances))
-                else:
-                    # Default if we can't estimate properly
-                    grid_size = min(width, height) // 10
+                # Use median of pairwise distances to be robust to outliers
+                grid_size = int(np.median(pdist(points)))
         else:
             # Default if we can't estimate
             grid_size = min(width, height) // 10
 
+    # A writer opened here is done once the grid is found, a caller's writer stays open
+    if debug and debug is not debug_output:
+        debug.close()
+
+    if return_lattice:
+        return img, grid_size, lattice
+    return img, grid_size
+
+
+def extract_pixel_array(image_path, grid_size=None, threshold=170, cell_threshold=0.15,
+                        purple_boost=True, blob_detection=True, debug_output=False, registration=True,
+                        block_size=35, cache=None, perspective=False, corners=None):
+    """
+    Extract a binary pixel array from an image containing glowing pixels.
+
+    Args:
+        image_path: Path to the input image, or an already decoded BGR image
+        grid_size: Size of the grid cells (if None, will attempt to detect automatically)
+        threshold: Brightness threshold (0-255) to identify pixels (lower for purple glow)
+        cell_threshold: Minimum ratio of bright pixels in a cell to consider it "on"
+        purple_boost: Enhance purple components for better glow detection
+        blob_detection: Use blob detection for more accurate pixel centers
+        debug_output: Whether to save debug visualization images, or a DebugImageWriter to write them with
+                      (left open, so the images can still be encoding when this returns)
+        registration: Register pitch, offset and rotation of the grid from the image spectrum
+                      (blob or contour detection is only used when no lattice is found)
+        block_size: Size of the pixel neighborhood for adaptive thresholding (odd), used to estimate the grid size
+        cache: Optional PreprocessCache (see cache.py). The located grid and the per-cell counts of every
+               threshold are stored for the image file, so runs with other thresholds skip the image entirely
+        perspective: Correct the perspective of a panel photographed at an angle (see rectify_panel)
+        corners: Four (x, y) corners of the panel, implies perspective (default: found automatically)
+
+    Returns:
+        pixel_array: Binary numpy array where 1s represent detected pixels
+        grid_size: The grid size used for the array
+    """
+    # Cached runs classify from the stored session, they are skipped when debug images are wanted
+    perspective = perspective or corners is not None
+    if (cache is not None and isinstance(image_path, str) and not debug_output and not perspective
+            and float(threshold).is_integer()):
+        key = cache.key(image_path, grid_size=grid_size, purple_boost=purple_boost, blob_detection=blob_detection,
+                        registration=registration, block_size=block_size)
+        state = cache.get(key)
+        if state is not None and (state['registered'] or state['locate_threshold'] == threshold):
+            session = ExtractionSession.from_state(state)
+            print(f"Using cached grid size: {session.grid_size} pixels")
+        else:
+            session = ExtractionSession(image_path, grid_size, threshold, purple_boost, blob_detection,
+                                        registration, block_size=block_size)
+            cache.put(key, session.get_state())
+            print(f"Using grid size: {session.grid_size} pixels")
+        return session.classify(threshold, cell_threshold), session.grid_size
+
+    # Load image and find its grid
+    img = _load_image(image_path)
+    debug = _debug_writer(debug_output)
+    if perspective:
+        img, grid_size = rectify_panel(img, corners, grid_size, threshold, purple_boost, blob_detection,
+                                       registration, debug, block_size)
+        if debug:
+            debug.write("rectified.png", img)
+    else:
+        img, grid_size = locate_grid(img, grid_size, threshold, purple_boost, blob_detection,
+                                     registration, debug, block_size)
     print(f"Using grid size: {grid_size} pixels")
 
-    # Detect grid alignment
-    # To handle slight rotation or stretching, try to find the actual grid
-    # by looking for alignment patterns in the detected points
-
-    # For simplicity, we'll use a hough line approach to detect potential grid lines
-    # This helps with slight rotation
-    if len(centers) > 5 and debug_output:
-        alignment_img = np.zeros((height, width), dtype=np.uint8)
-        for cx, cy in centers:
-            cv2.circle(alignment_img, (cx, cy), 3, 255, -1)
-
-        lines = cv2.HoughLines(alignment_img, 1, np.pi / 180, threshold=3)
-        if lines is not None:
-            alignment_debug = img.copy()
-            for line in lines:
-                rho, theta = line[0]
-                a = np.cos(theta)
-                b = np.sin(theta)
-                x0 = a * rho
-                y0 = b * rho
-                x1 = int(x0 + 1000 * (-b))
-                y1 = int(y0 + 1000 * (a))
-                x2 = int(x0 - 1000 * (-b))
-                y2 = int(y0 - 1000 * (a))
-                cv2.line(alignment_debug, (x1, y1), (x2, y2), (0, 0, 255), 1)
-
-            cv2.imwrite("debug/grid_alignment.png", alignment_debug)
-
-    # Calculate grid dimensions
-    grid_width = width // grid_size
-    grid_height = height // grid_size
-
-    # Create empty grid
-    grid = np.zeros((grid_height, grid_width), dtype=int)
-
-    # Create debug visualization if requested
-    if debug_output:
-        debug_img = img.copy()
-
-    # Check each grid cell using a more sophisticated approach for purple glow
-    for y in range(grid_height):
-        for x in range(grid_width):
-            # Extract the region
-            cell_y_start = y * grid_size
-            cell_y_end = min((y + 1) * grid_size, height)
-            cell_x_start = x * grid_size
-            cell_x_end = min((x + 1) * grid_size, width)
-
-            # Get the cell as a rectangular region
-            cell_rgb = img[cell_y_start:cell_y_end, cell_x_start:cell_x_end]
-
-            if purple_boost:
-                # Check for presence of purple glow (high in red and blue, low in green)
-                b, g, r = cv2.split(cell_rgb)
-
-                # Calculate purple score: high where blue and red are high but green is low
-                purple_score = (b.astype(np.float32) + r.astype(np.float32)) / 2 - g.astype(np.float32) * 0.5
-                purple_score = np.clip(purple_score, 0, 255)
-
-                # Find bright areas in the normal cell too
-                cell_gray = cv2.cvtColor(cell_rgb, cv2.COLOR_BGR2GRAY)
-
-                # Combine brightness and purple score
-                combined_score = (cell_gray.astype(np.float32) * 0.7 + purple_score * 0.3)
-
-                # Check ratio of high-scoring pixels
-                high_score_ratio = np.sum(combined_score > threshold) / combined_score.size
-
-                # Also check for bright center - strong indicator of a pixel
-                center_region = cell_gray[cell_gray.shape[0] // 4:3 * cell_gray.shape[0] // 4,
-                                cell_gray.shape[1] // 4:3 * cell_gray.shape[1] // 4]
-                center_brightness = np.mean(center_region)
-
-                # Mark as a pixel if either condition is met
-                if high_score_ratio > cell_threshold or center_brightness > threshold + 20:
-                    grid[y, x] = 1
-            else:
-                # Just use grayscale approach if not boosting purple
-                cell_gray = cv2.cvtColor(cell_rgb, cv2.COLOR_BGR2GRAY)
-                bright_ratio = np.sum(cell_gray > threshold) / cell_gray.size
-                if bright_ratio > cell_threshold:
-                    grid[y, x] = 1
-
-            # Add grid visualization for debugging
-            if debug_output:
-                color = (0, 255, 0) if grid[y, x] == 1 else (0, 0, 255)
-                cv2.rectangle(debug_img,
-                              (cell_x_start, cell_y_start),
-                              (cell_x_end, cell_y_end),
-                              color, 2)
+    # Classify every cell at once on whole-image scores
+    score, gray = compute_pixel_scores(img, purple_boost)
+    grid = classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost)
 
     # Save debug visualizations if requested
-    if debug_output:
-        cv2.imwrite("debug/grid_detection.png", debug_img)
+    if debug:
+        debug.write("grid_detection.png", draw_cell_grid(img, grid, grid_size))
 
         # Create visualization of the detected grid
-        grid_vis = np.zeros((grid_height * 10, grid_width * 10), dtype=np.uint8)
-        for y in range(grid_height):
-            for x in range(grid_width):
-                if grid[y, x] == 1:
-                    grid_vis[y * 10:(y + 1) * 10, x * 10:(x + 1) * 10] = 255
-        cv2.imwrite("debug/detected_array.png", grid_vis)
+        grid_vis = np.repeat(np.repeat(grid.astype(np.uint8) * 255, 10, axis=0), 10, axis=1)
+        debug.write("detected_array.png", grid_vis)
+
+        if debug is not debug_output:
+            debug.close()
 
     return grid, grid_size
 
 
+def extract_palette_array(image_path, n_colors=4, grid_size=None, robust=False, threshold=170, cell_threshold=0.15,
+                          purple_boost=True, blob_detection=True, registration=True, block_size=35,
+                          white_level=230, debug_output=False):
+    """
+    Extract an indexed color pixel array from an image of multi-colored pixels.
+
+    The grid is located and the cells are classified lit or background like in extract_pixel_array. Index 0
+    is the background, and the colors of the lit cells only are clustered into the n_colors - 1 other
+    palette entries: the glow of lit pixels tints the background cells around them, which would otherwise
+    be spread over the colored entries.
+
+    Args:
+        image_path: Path to the input image, or an already decoded BGR image
+        n_colors: Number of palette entries, background included
+        robust: Use the median color of each cell instead of its mean
+        grid_size, threshold, cell_threshold, purple_boost, blob_detection, registration, block_size,
+        debug_output: See extract_pixel_array
+        white_level: Pixels of a lit cell with every channel at or above it are left out of its color,
+                     see compute_cell_colors
+
+    Returns:
+        index_array: uint8 numpy array of palette indices, 0 is the background
+        palette: uint8 array of shape (n_colors, 3) with the RGB color of each entry, the lit entries ordered
+                 by brightness. It has fewer entries when there are fewer lit cells than colors
+        grid_size: The grid size used for the array
+
+    Raises:
+        ValueError: When n_colors leaves no entry for the lit cells
+    """
+    if n_colors < 2:
+        raise ValueError(f"A palette needs a background and at least one color, got {n_colors} colors")
+    img = _load_image(image_path)
+    debug = _debug_writer(debug_output)
+    img, grid_size = locate_grid(img, grid_size, threshold, purple_boost, blob_detection,
+                                 registration, debug, block_size)
+    print(f"Using grid size: {grid_size} pixels")
+
+    score, gray = compute_pixel_scores(img, purple_boost)
+    lit = classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost).astype(bool)
+
+    index_array = np.zeros(lit.shape, dtype=np.uint8)
+    background = compute_cell_colors(img, grid_size, robust)[~lit]
+    palette = [background.mean(axis=0) if len(background) else np.zeros(3)]
+    if lit.any():
+        colors = compute_cell_colors(img, grid_size, robust, white_level)[lit]
+        labels, centers = kmeans_colors(colors, n_colors - 1)
+
+        # Order the lit entries by brightness, after the background
+        order = np.argsort(centers @ np.array([0.114, 0.587, 0.299]))
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        index_array[lit] = ranks[labels] + 1
+        palette.extend(centers[order])
+    palette = np.clip(np.round(np.array(palette)[:, ::-1]), 0, 255).astype(np.uint8)
+
+    if debug:
+        # Cells painted with their palette color
+        preview = np.repeat(np.repeat(palette[index_array][:, :, ::-1], 10, axis=0), 10, axis=1)
+        debug.write("palette_array.png", np.ascontiguousarray(preview))
+        if debug is not debug_output:
+            debug.close()
+
+    return index_array, palette, grid_size
+
+
+def split_sprites(pixel_array, gap=12, min_cells=1):
+    """
+    Split a pixel array holding several sprites (e.g. a capture of multiple faces) into one array per sprite.
+
+    Lit cells are grouped into connected components after a dilation of gap cells, so that the separate
+    parts of a sprite (eyes, mouth) stay together while sprites further apart than that are split.
+
+    Args:
+        pixel_array: Pixel array classified once for the whole image
+        gap: Largest number of unlit cells between two parts of the same sprite
+        min_cells: Sprites with fewer lit cells are dropped as noise
+
+    Returns:
+        sprites: List of dicts with the trimmed 'array' of each sprite, its 'bbox' (row, col, height, width)
+                 in the pixel array and its number of lit 'cells', in reading order of their first cell
+    """
+    lit = pixel_array > 0
+    grown = ndimage.binary_dilation(lit, structure=np.ones((2 * gap + 1, 2 * gap + 1), bool)) if gap else lit
+    labels, _ = ndimage.label(grown, structure=np.ones((3, 3), bool))
+
+    # Only the lit cells belong to the sprites, the dilation just links them
+    labels[~lit] = 0
+    cells = np.bincount(labels.ravel())
+    sprites = []
+    for label, box in enumerate(ndimage.find_objects(labels), start=1):
+        if box is None or cells[label] < min_cells:
+            continue
+        sprite = np.where(labels[box] == label, pixel_array[box], 0)
+        sprites.append({'array': sprite, 'bbox': (box[0].start, box[1].start, *sprite.shape),
+                        'cells': int(cells[label])})
+    return sprites
+
+
+def save_sprites(sprites, directory="npy", prefix="sprite", grid_size=None, source=None):
+    """
+    Save every sprite of split_sprites to its own .npy file, with a JSON manifest of where they came from.
+
+    Args:
+        sprites: Result of split_sprites
+        directory: Where the sprite arrays and the manifest are written
+        prefix: Sprites are saved as {prefix}_{index}.npy and the manifest as {prefix}_sprites.json
+        grid_size: Grid size of the source image, recorded in the manifest
+        source: Path of the source image, recorded in the manifest
+
+    Returns:
+        manifest_path: Path of the manifest
+    """
+    import json
+    os.makedirs(directory, exist_ok=True)
+    entries = []
+    for index, sprite in enumerate(sprites):
+        filename = f"{prefix}_{index}.npy"
+        np.save(os.path.join(directory, filename), sprite['array'])
+        row, col, height, width = sprite['bbox']
+        entries.append({'file': filename, 'row': int(row), 'col': int(col),
+                        'height': int(height), 'width': int(width), 'cells': sprite['cells']})
+
+    manifest_path = os.path.join(directory, f"{prefix}_sprites.json")
+    with open(manifest_path, 'w') as f:
+        json.dump({'source': source, 'grid_size': grid_size, 'sprites': entries}, f, indent=4)
+    return manifest_path
+
+
+class ExtractionSession:
+    """
+    Extraction of one image that can be re-classified with any threshold and cell_threshold in O(cells).
+
+    The grid is located and the per-pixel scores are computed once. For every quantized threshold t,
+    the session keeps the number of pixels scoring above t in each cell: a summed table over the
+    threshold axis, built in a single histogram pass instead of one integral image per threshold.
+    """
+
+    def __init__(self, image, grid_size=None, threshold=170, purple_boost=True, blob_detection=True,
+                 registration=True, threshold_range=(0, 255), threshold_step=1, debug_output=False,
+                 block_size=35):
+        """
+        Args:
+            image: Path to the input image, or an already decoded BGR image
+            grid_size, purple_boost, blob_detection, registration, debug_output, block_size:
+                See extract_pixel_array
+            threshold: Brightness threshold used while locating the grid (when it falls back to blobs)
+            threshold_range: Lowest and highest threshold that can be classified
+            threshold_step: Spacing of the quantized thresholds, others are rounded down to the level below
+        """
+        img = _load_image(image)
+        self.image, self.grid_size, lattice = locate_grid(img, grid_size, threshold, purple_boost, blob_detection,
+                                                          registration, debug_output, block_size,
+                                                          return_lattice=True)
+        # Without a registered lattice, the grid estimate depends on the threshold it was located with
+        self.registered = lattice is not None
+        self.locate_threshold = threshold
+        self.purple_boost = purple_boost
+        self.levels = np.arange(threshold_range[0], threshold_range[1] + 1, threshold_step)
+
+        gs = self.grid_size
+        score, gray = compute_pixel_scores(self.image, purple_boost)
+        cells = block_view(score, gs)
+        grid_height, grid_width = cells.shape[0], cells.shape[2]
+        self.shape = (grid_height, grid_width)
+
+        # For an integer t, score > t exactly when ceil(score) > t, so each pixel only needs
+        # the number of levels below its rounded up score
+        bins = len(self.levels) + 1
+        level_lut = np.searchsorted(self.levels, np.arange(257), side='left').astype(np.int32)
+        pixel_bins = level_lut[np.ceil(cells).astype(np.int32)]
+
+        # Histogram of the pixel bins of every cell, in one pass. The keys go up to cells x bins, past
+        # the int32 range from about 8M cells
+        cell_index = (np.arange(grid_height, dtype=np.int64)[:, None, None, None] * grid_width +
+                      np.arange(grid_width, dtype=np.int64)[None, None, :, None])
+        histogram = np.bincount((cell_index * bins + pixel_bins).ravel(), minlength=grid_height * grid_width * bins)
+        histogram = histogram.reshape(grid_height, grid_width, bins)
+
+        # Pixels above levels[k] are the ones in bins k + 1 and up
+        above = np.cumsum(histogram[:, :, ::-1], axis=2)[:, :, ::-1]
+        self.counts_above = np.ascontiguousarray(np.moveaxis(above[:, :, 1:], 2, 0)).astype(np.int32)
+
+        # The bright center test does not depend on the ratio, its mean is kept per cell
+        start, end = gs // 4, 3 * gs // 4
+        if purple_boost and end > start:
+            self.center_brightness = block_view(gray, gs)[:, start:end, :, start:end].mean(axis=(1, 3))
+        else:
+            self.center_brightness = None
+
+    def get_state(self):
+        """
+        Returns what classify and sweep need as a dict of arrays, suitable for np.savez,
+        so that a session can be restored without the image.
+        """
+        return dict(grid_size=self.grid_size,
+                    registered=self.registered,
+                    locate_threshold=self.locate_threshold,
+                    purple_boost=self.purple_boost,
+                    levels=self.levels,
+                    counts_above=self.counts_above,
+                    has_center=self.center_brightness is not None,
+                    center_brightness=self.center_brightness if self.center_brightness is not None else np.empty(0))
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore a session from the arrays returned by get_state, possibly reloaded from disk.
+        The restored session has no image.
+        """
+        session = cls.__new__(cls)
+        session.image = None
+        session.grid_size = int(state['grid_size'])
+        session.registered = bool(state['registered'])
+        session.locate_threshold = np.asarray(state['locate_threshold']).item()
+        session.purple_boost = bool(state['purple_boost'])
+        session.levels = np.array(state['levels'])
+        session.counts_above = np.array(state['counts_above'])
+        session.shape = session.counts_above.shape[1:]
+        session.center_brightness = np.array(state['center_brightness']) if state['has_center'] else None
+        return session
+
+    def _level_index(self, threshold):
+        if not self.levels[0] <= threshold <= self.levels[-1]:
+            raise ValueError(f"Threshold {threshold} is outside of the session range "
+                             f"[{self.levels[0]}, {self.levels[-1]}]")
+        return np.searchsorted(self.levels, threshold, side='right') - 1
+
+    def fill_ratios(self, thresholds):
+        """Ratio of the pixels of each cell scoring above each threshold, shape (len(thresholds),) + self.shape"""
+        indices = [self._level_index(t) for t in thresholds]
+        return self.counts_above[indices] / (self.grid_size * self.grid_size)
+
+    def classify(self, threshold=170, cell_threshold=0.15):
+        """
+        Classify every cell, like classify_cells on the located grid.
+
+        Returns:
+            grid: Binary numpy array of shape self.shape
+        """
+        grid = self.fill_ratios([threshold])[0] > cell_threshold
+        if self.center_brightness is not None:
+            grid |= self.center_brightness > threshold + 20
+        return grid.astype(int)
+
+    def sweep(self, thresholds, cell_thresholds):
+        """
+        Classify every combination of thresholds and cell_thresholds at once, for batch tuning.
+
+        Returns:
+            grids: Boolean array of shape (len(thresholds), len(cell_thresholds)) + self.shape
+        """
+        thresholds = np.asarray(thresholds)
+        grids = self.fill_ratios(thresholds)[:, None] > np.asarray(cell_thresholds)[None, :, None, None]
+        if self.center_brightness is not None:
+            grids |= (self.center_brightness[None] > thresholds[:, None, None] + 20)[:, None]
+        return grids
+
+
+def _cell_stamps(kernel, grid_size):
+    """
+    Cut a kernel centered on a cell center into the tiles it adds to the surrounding cells.
+
+    Args:
+        kernel: Square float32 kernel of odd size, centered on the center of a cell
+        grid_size: Size of each grid cell in the output image
+
+    Returns:
+        stamps: float32 array of shape ((2 * reach + 1) ** 2, grid_size ** 2), the row of a cell offset
+                holds the tile the kernel adds to the cell at that offset from the lit cell
+        reach: Number of cells the kernel reaches around its cell
+    """
+    half = kernel.shape[0] // 2
+    reach = half // grid_size + 1
+    cells = 2 * reach + 1
+    canvas = np.zeros((cells * grid_size, cells * grid_size), dtype=np.float32)
+    start = reach * grid_size + grid_size // 2 - half
+    canvas[start:start + kernel.shape[0], start:start + kernel.shape[1]] = kernel
+    stamps = canvas.reshape(cells, grid_size, cells, grid_size).transpose(0, 2, 1, 3)
+    return stamps.reshape(cells * cells, grid_size * grid_size), reach
+
+
+def _glow_colors(glow, glow_color, background_color, glow_intensity):
+    """
+    Colors of glow values (0-1) over the background. The glow fades both in color and in alpha, like a
+    blurred RGBA layer pasted with its own mask.
+
+    Returns:
+        colors: uint8 RGB array with one row per glow value
+    """
+    glow = np.asarray(glow, dtype=np.float32)[:, None]
+    background = np.float32(background_color)
+    blended = background + (glow * np.float32(glow_color) - background) * glow * glow_intensity
+    return np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+
+# Glow falloffs of the distance glow mode, from 1 at the edge of a pixel (t = 0) to its full extent (t = 1)
+GLOW_FALLOFFS = {
+    'gaussian': lambda t: np.exp(-4.5 * t * t),
+    'linear': lambda t: 1 - t,
+    'smoothstep': lambda t: 1 - t * t * (3 - 2 * t),
+}
+
+
+def _distance_glow_extent(pixel_size, glow_radius):
+    """Distance from the edge of a white square at which the distance glow reaches 0"""
+    return max(pixel_size // 2 + 2 * glow_radius, 1)
+
+
+def _glow_half_size(pixel_size, glow_radius, glow_mode='blur'):
+    """Distance from the center of a lit cell to the farthest output pixel its rendering changes"""
+    if glow_mode == 'distance':
+        return pixel_size // 2 + _distance_glow_extent(pixel_size, glow_radius)
+    return max(pixel_size + glow_radius + int(np.ceil(3 * glow_radius / 2)), pixel_size // 2)
+
+
+def render_reach(grid_size=30, pixel_size=None, glow_radius=None, glow_mode='blur'):
+    """
+    Number of cells around a lit cell that its rendering (glow included) can change, with the defaults of
+    render_pixel_image. A region of cells renders like in the whole image from the cells this far around it.
+    """
+    if pixel_size is None:
+        pixel_size = int(grid_size * 0.6)
+    if glow_radius is None:
+        glow_radius = int(grid_size * 0.8)
+    return _glow_half_size(pixel_size, glow_radius, glow_mode) // grid_size + 1
+
+
+def _render_distance_glow(lit, grid_size, pixel_size, glow_radius, glow_color, background_color,
+                          glow_intensity, falloff):
+    """
+    Glow from the distance of every output pixel to the nearest white square, through a lookup table.
+
+    Args:
+        lit: Boolean array of the lit cells
+        falloff: Name in GLOW_FALLOFFS, or a function mapping t = distance / extent (0-1) to the glow (0-1)
+        Others: See render_pixel_image
+
+    Returns:
+        rgb: uint8 array of the rendered image
+    """
+    height, width = lit.shape
+    falloff = GLOW_FALLOFFS[falloff] if isinstance(falloff, str) else falloff
+
+    # White squares: the cell centers, dilated (a separable rectangle, whatever the glow radius)
+    squares = np.zeros((height * grid_size, width * grid_size), dtype=np.uint8)
+    rows, cols = np.nonzero(lit)
+    squares[rows * grid_size + grid_size // 2, cols * grid_size + grid_size // 2] = 255
+    side = 2 * (pixel_size // 2) + 1
+    squares = cv2.dilate(squares, cv2.getStructuringElement(cv2.MORPH_RECT, (side, side)))
+
+    # Distance of the other pixels to the squares, over the glow extent in 255 steps
+    distance = cv2.distanceTransform(cv2.bitwise_not(squares), cv2.DIST_L2, cv2.DIST_MASK_5)
+    extent = _distance_glow_extent(pixel_size, glow_radius)
+    steps = cv2.convertScaleAbs(distance, alpha=255 / extent)
+    del distance
+
+    t = np.arange(256, dtype=np.float32) / 255
+    lut = _glow_colors(np.where(t < 1, falloff(t), 0), glow_color, background_color, glow_intensity)
+    rgb = cv2.applyColorMap(steps, np.ascontiguousarray(lut[:, None, :]))
+    return cv2.bitwise_or(rgb, (255, 255, 255, 0), dst=rgb, mask=squares)
+
+
 def render_pixel_image(pixel_array, grid_size=30, pixel_size=None,
                        glow_radius=None, glow_color=(128, 0, 255),
-                       background_color=(0, 0, 0), glow_intensity=0.8):
+                       background_color=(0, 0, 0), glow_intensity=0.8, levels=1024,
+                       glow_mode='blur', falloff='gaussian', as_array=False, region=None):
     """
     Render an image from a binary pixel array with glowing effect.
 
+    Every glow is identical, so the glow of a single pixel (a disc of radius pixel_size + glow_radius,
+    blurred) and its white square are computed once, as one kernel. Each row of cells is rendered by a
+    single matrix product of the lit cells around it with the tiles of that kernel, which gives the glow
+    level of every output pixel (overlapping glows add up to full glow). Levels are turned into colors
+    through a lookup table computed in float32, straight into the uint8 output.
+
+    The blur costs more as glow_radius grows. The 'distance' glow mode instead maps the distance of every
+    pixel to the nearest white square through a falloff lookup table, in the same time whatever the radius.
+
     Args:
         pixel_array: Binary numpy array where 1s represent pixels to draw
         grid_size: Size of each grid cell in the output image
@@ -341,6 +1237,12 @@ def render_pixel_image(pixel_array, grid_size=30, pixel_size=None,
         glow_color: RGB color tuple for the glow
         background_color: RGB color tuple for the background
         glow_intensity: Intensity of the glow effect (0-1)
+        levels: Number of glow levels of the lookup table
+        glow_mode: 'blur' for the blurred disc glow, 'distance' for the distance transform glow
+        falloff: Falloff of the 'distance' glow mode, a name in GLOW_FALLOFFS or a function of the
+                 distance over the glow extent (0-1)
+        as_array: Return the uint8 RGBA array instead of a PIL Image, without a copy
+        region: (rows, cols) slices of the cells to render, the other cells only glow into them
 
     Returns:
         PIL Image with the rendered result
@@ -353,63 +1255,192 @@ def render_pixel_image(pixel_array, grid_size=30, pixel_size=None,
 
     # Calculate dimensions
     height, width = pixel_array.shape
-    img_width = width * grid_size
-    img_height = height * grid_size
+    rows, cols = region if region is not None else (slice(0, height), slice(0, width))
+    img_width = (cols.stop - cols.start) * grid_size
+    img_height = (rows.stop - rows.start) * grid_size
+
+    lit = pixel_array == 1
+    if glow_mode == 'distance' and lit.any():
+        rgb = _render_distance_glow(lit, grid_size, pixel_size, glow_radius, glow_color,
+                                    background_color, glow_intensity, falloff)
+        rgb = rgb[rows.start * grid_size:rows.stop * grid_size, cols.start * grid_size:cols.stop * grid_size]
+        result = cv2.cvtColor(rgb, cv2.COLOR_RGB2RGBA)
+        return result if as_array else Image.fromarray(result, 'RGBA')
+    if glow_mode not in ('blur', 'distance'):
+        raise ValueError(f"Unknown glow mode: {glow_mode}")
+
+    result = np.empty((img_height, img_width, 4), dtype=np.uint8)
+    result[...] = (*background_color, 255)
+    if not lit.any():
+        return result if as_array else Image.fromarray(result, 'RGBA')
+    lit = lit.astype(np.float32)
+
+    # Glow of a single pixel: a disc, blurred, scaled to the levels of the lookup table
+    glow_size = pixel_size + glow_radius
+    sigma = glow_radius / 2
+    half = _glow_half_size(pixel_size, glow_radius, glow_mode)
+    offsets = np.abs(np.arange(-half, half + 1))
+    kernel = (np.hypot(offsets[:, None], offsets[None, :]) <= glow_size).astype(np.float32)
+    if sigma > 0:
+        kernel = cv2.GaussianBlur(kernel, (0, 0), sigma)
+    glow_stamps, reach = _cell_stamps(kernel * (levels - 1), grid_size)
+    cells = 2 * reach + 1
+
+    # Its white square on top, weighted so that pixels under a square land past any sum of glows
+    square = (np.maximum(offsets[:, None], offsets[None, :]) <= pixel_size // 2).astype(np.float32)
+    white = cells * cells * levels
+    stamps = glow_stamps + white * _cell_stamps(square, grid_size)[0]
+
+    # Colors of the glow levels. Level k stands for the glow values from k to k + 1, overlapping glows
+    # summing past the last level are full glow
+    glow = np.minimum((np.arange(levels, dtype=np.float32) + 0.5) / (levels - 1), 1)
+    lut = np.empty((white + 1, 3), dtype=np.uint8)
+    lut[:levels] = _glow_colors(glow, glow_color, background_color, glow_intensity)
+    lut[levels:white] = lut[levels - 1]
+    lut[white] = 255
+
+    # Lit cells around every cell, the window is flipped so that cell offsets match the stamps
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(lit, 2 * reach), (cells, cells))
+
+    region_width = cols.stop - cols.start
+    for row in range(rows.start, rows.stop):
+        neighbours = windows[row + reach, cols.start + reach:cols.stop + reach, ::-1, ::-1].reshape(region_width, -1)
+        if not neighbours.any():
+            continue
+        tiles = np.minimum(neighbours @ stamps, white).astype(np.int32)
+        # Tiles of the row side by side: (grid_size, region_width, grid_size) in image layout
+        tiles = tiles.reshape(region_width, grid_size, grid_size).transpose(1, 0, 2)
+        y = (row - rows.start) * grid_size
+        result[y:y + grid_size, :, :3] = lut[tiles].reshape(grid_size, img_width, 3)
+
+    return result if as_array else Image.fromarray(result, 'RGBA')
+
+
+def render_pixel_region(pixel_array, rows, cols, grid_size=30, reach=None, **render_options):
+    """
+    Render the cells in the rows and cols ranges exactly like in the whole image, from the cells within
+    reach around them only (see render_reach).
 
-    # Create a blank image with the specified background color
-    bg_color_rgba = background_color + (255,)
-    image = Image.new('RGBA', (img_width, img_height), color=bg_color_rgba)
-    draw = ImageDraw.Draw(image)
+    Returns:
+        region: uint8 RGBA array of the rendered cells
+    """
+    if reach is None:
+        reach = render_reach(grid_size, render_options.get('pixel_size'), render_options.get('glow_radius'),
+                             render_options.get('glow_mode', 'blur'))
+    height, width = pixel_array.shape
+    top, left = max(rows.start - reach, 0), max(cols.start - reach, 0)
+    bottom, right = min(rows.stop + reach, height), min(cols.stop + reach, width)
 
-    # Create a separate image for the glow effect
-    glow_image = Image.new('RGBA', (img_width, img_height), color=(0, 0, 0, 0))
-    glow_draw = ImageDraw.Draw(glow_image)
+    region = (slice(rows.start - top, rows.stop - top), slice(cols.start - left, cols.stop - left))
+    return render_pixel_image(pixel_array[top:bottom, left:right], grid_size, as_array=True, region=region,
+                              **render_options)
 
-    # Calculate alpha for glow based on intensity
-    glow_alpha = int(255 * glow_intensity)
-    glow_color_rgba = glow_color + (glow_alpha,)
 
-    # Draw each pixel
-    for y in range(height):
-        for x in range(width):
-            if pixel_array[y, x] == 1:
-                # Calculate center position
-                center_x = x * grid_size + grid_size // 2
-                center_y = y * grid_size + grid_size // 2
-
-                # Draw the glow (larger circle with color)
-                glow_size = pixel_size + glow_radius
-                glow_draw.ellipse(
-                    [
-                        center_x - glow_size,
-                        center_y - glow_size,
-                        center_x + glow_size,
-                        center_y + glow_size
-                    ],
-                    fill=glow_color_rgba
-                )
-
-                # Draw the base white square
-                half_size = pixel_size // 2
-                draw.rectangle(
-                    [
-                        center_x - half_size,
-                        center_y - half_size,
-                        center_x + half_size,
-                        center_y + half_size
-                    ],
-                    fill=(255, 255, 255, 255)  # Solid white
-                )
-
-    # Apply blur to the glow image
-    glow_image = glow_image.filter(ImageFilter.GaussianBlur(radius=glow_radius / 2))
-
-    # Composite: first the glow, then the white squares on top
-    result = Image.new('RGBA', (img_width, img_height), color=bg_color_rgba)
-    result.paste(glow_image, (0, 0), glow_image)
-    result.paste(image, (0, 0), image)
+def changed_regions(frame, base, reach):
+    """
+    Regions of the output that change from base to frame, as slices of cells.
 
-    return result
+    Changed cells are grouped when their glows can overlap, and each group is grown by reach cells, the
+    cells whose rendering they can change (see render_reach).
+
+    Returns:
+        regions: List of (rows, cols) slices of cells, clipped to the array
+    """
+    changed = (frame == 1) != (base == 1)
+    if not changed.any():
+        return []
+    grown = ndimage.binary_dilation(changed, structure=np.ones((2 * reach + 1, 2 * reach + 1), bool))
+    labels, _ = ndimage.label(grown, structure=np.ones((3, 3), bool))
+    height, width = frame.shape
+    # The dilation already grew every group by reach cells, within the array
+    return [(slice(box[0].start, min(box[0].stop, height)), slice(box[1].start, min(box[1].stop, width)))
+            for box in ndimage.find_objects(labels)]
+
+
+class GlowPreview:
+    """
+    Glow render of a pixel array being edited, kept up to date by a worker thread.
+
+    update() only compares the array with the last one it was given, so it can be called on every frame
+    of an editor. The worker re-renders the regions around the changed cells (see changed_regions) and
+    queues them as patches, which the caller applies with patches() so that surfaces stay on its thread.
+    """
+
+    def __init__(self, pixel_array, grid_size=10, **render_options):
+        """
+        Args:
+            pixel_array: The array being edited
+            grid_size: Size of each grid cell in the preview
+            render_options: Other arguments of render_pixel_image
+        """
+        import queue
+        import threading
+        self.grid_size = grid_size
+        self.render_options = render_options
+        self.size = (pixel_array.shape[1] * grid_size, pixel_array.shape[0] * grid_size)
+        self._reach = render_reach(grid_size, render_options.get('pixel_size'), render_options.get('glow_radius'),
+                                   render_options.get('glow_mode', 'blur'))
+        self._submitted = pixel_array.copy()
+        self._pending = self._submitted
+        self._closed = False
+        self._condition = threading.Condition()
+        self._patches = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, pixel_array):
+        """Hand the current array to the worker if it changed since the last call"""
+        if np.array_equal(pixel_array, self._submitted):
+            return
+        self._submitted = pixel_array.copy()
+        with self._condition:
+            self._pending = self._submitted
+            self._condition.notify()
+
+    def _run(self):
+        rendered = None
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                # Edits made while rendering are merged into the next pass
+                pixel_array, self._pending = self._pending, None
+
+            regions = [] if rendered is None else changed_regions(pixel_array, rendered, self._reach)
+            halo_cells = sum((rows.stop - rows.start + 2 * self._reach) * (cols.stop - cols.start + 2 * self._reach)
+                             for rows, cols in regions)
+            if rendered is None or halo_cells >= pixel_array.size:
+                regions = [(slice(0, pixel_array.shape[0]), slice(0, pixel_array.shape[1]))]
+            for rows, cols in regions:
+                if self._closed:
+                    return
+                patch = render_pixel_region(pixel_array, rows, cols, self.grid_size, self._reach,
+                                            **self.render_options)
+                self._patches.put((cols.start * self.grid_size, rows.start * self.grid_size, patch))
+            rendered = pixel_array
+
+    def patches(self):
+        """
+        Rendered patches not applied yet, oldest first.
+
+        Returns:
+            patches: List of (x, y, rgba) with the position of each uint8 RGBA patch in the preview
+        """
+        patches = []
+        while not self._patches.empty():
+            patches.append(self._patches.get())
+        return patches
+
+    def close(self):
+        """
+        Ask the worker thread to stop, without waiting for it: a render in progress would block the caller.
+        The worker exits once it is done with the current region, its patches are dropped.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
 
 
 def save_pixel_array(pixel_array, filename):
@@ -704,13 +1735,15 @@ def show_circle_popup(screen):
     return result
 
 
-def create_interactive_editor(pixel_array, background_image_path=None):
+def create_interactive_editor(pixel_array, background_image_path=None, preview_options=None):
     """
     Create an interactive pixel editor using Pygame
 
     Args:
         pixel_array: The initial pixel array to edit
         background_image_path: Optional path to a background image
+        preview_options: Arguments of GlowPreview for the glow preview (P key): its grid_size, and render_pixel_image
+                         options like glow_color
 
     Returns:
         The edited pixel array
@@ -764,6 +1797,11 @@ def create_interactive_editor(pixel_array, background_image_path=None):
     background_opacity = 0.3
     grid_visible = True
 
+    # Glow preview pane, rendered in the background while editing
+    preview = None
+    preview_surface = None
+    preview_scaled = None
+
     # Clone the original array for undo
     original_array = pixel_array.copy()
 
@@ -803,6 +1841,14 @@ def create_interactive_editor(pixel_array, background_image_path=None):
                     running = False
                 elif event.key == pygame.K_g:
                     grid_visible = not grid_visible
+                elif event.key == pygame.K_p:
+                    if preview:
+                        preview.close()
+                        preview = None
+                    else:
+                        preview = GlowPreview(pixel_array, **(preview_options or {}))
+                        preview_surface = pygame.Surface(preview.size)
+                        preview_scaled = None
                 elif event.key == pygame.K_r:
                     pixel_array = original_array.copy()
                 elif event.key == pygame.K_c:
@@ -1006,6 +2052,7 @@ def create_interactive_editor(pixel_array, background_image_path=None):
             f"Mouse wheel: Zoom in/out",
             f"Shift + wheel: Adjust background opacity",
             f"G: Toggle grid",
+            f"P: Toggle glow preview",
             f"R: Reset",
             f"ESC: Save and exit",
             f"",
@@ -1022,11 +2069,30 @@ def create_interactive_editor(pixel_array, background_image_path=None):
         dim_surf = font.render(dim_text, True, text_color)
         screen.blit(dim_surf, (screen_width - dim_surf.get_width() - 10, 10))
 
+        # Draw the glow preview in the bottom right corner, patched as the worker renders edits
+        if preview:
+            preview.update(pixel_array)
+            for x, y, patch in preview.patches():
+                patch_surface = pygame.image.frombuffer(patch.tobytes(), (patch.shape[1], patch.shape[0]), 'RGBA')
+                preview_surface.blit(patch_surface, (x, y))
+                preview_scaled = None
+
+            pane_width = max(screen_width // 3, 100)
+            pane_height = pane_width * preview.size[1] // preview.size[0]
+            if preview_scaled is None or preview_scaled.get_width() != pane_width:
+                preview_scaled = pygame.transform.smoothscale(preview_surface, (pane_width, pane_height))
+            pane_x = screen_width - pane_width - 10
+            pane_y = screen_height - pane_height - 10
+            screen.blit(preview_scaled, (pane_x, pane_y))
+            pygame.draw.rect(screen, grid_color, (pane_x - 1, pane_y - 1, pane_width + 2, pane_height + 2), 1)
+
         # Update the display
         pygame.display.flip()
         clock.tick(60)  # Limit to 60 FPS
 
     # Clean up
+    if preview:
+        preview.close()
     pygame.quit()
     return pixel_array
 
@@ -1038,7 +2104,8 @@ def main():
     parser.add_argument('--input', '-i', help='Input image path to analyze')
     parser.add_argument('--output', '-o', default='textures/eyes_meow.png', help='Output image path')
     parser.add_argument('--save-array', '-s', default='npy/eyes_meow2.npy', help='Path to save the pixel array')
-    parser.add_argument('--load-array', '-l', help='Path to load an existing pixel array', default='npy/eyes_meow.npy')
+    parser.add_argument('--load-array', '-l', default='npy/eyes_meow.npy',
+                        help='Path to load an existing pixel array (ignored with --input or --example)')
     parser.add_argument('--example', '-e', action='store_true', help='Create an example cat face')
 
     # Analysis options
@@ -1049,9 +2116,43 @@ def main():
                         help='Ratio of bright pixels needed in a cell')
     parser.add_argument('--purple-boost', '-pb', action='store_true', default=True,
                         help='Enhance purple colors for better glow detection')
+    parser.add_argument('--no-purple-boost', dest='purple_boost', action='store_false',
+                        help='Classify cells on plain brightness')
     parser.add_argument('--blob-detection', '-bd', action='store_true', default=True,
                         help='Use blob detection for more accurate pixel centers')
+    parser.add_argument('--no-registration', dest='registration', action='store_false',
+                        help='Skip grid registration from the image spectrum (pitch, offset and rotation)')
+    parser.add_argument('--block-size', type=int, default=35,
+                        help='Neighborhood size (odd) of the adaptive threshold used to estimate the grid size')
+    parser.add_argument('--perspective', action='store_true',
+                        help='Correct the perspective of a panel photographed at an angle, its corners are found automatically')
+    parser.add_argument('--corners', help='Corners of the panel for --perspective (x1,y1;x2,y2;x3,y3;x4,y4, any order)')
+    parser.add_argument('--palette', type=int, metavar='COLORS',
+                        help='Extract an indexed array of this many colors (background included) and its palette, '
+                             'saved to --save-array and a _palette.json next to it, instead of a binary array')
+    parser.add_argument('--robust-color', action='store_true',
+                        help='Use the median color of each cell for --palette instead of its mean')
+    parser.add_argument('--sprites', action='store_true',
+                        help='Split the extracted array into one .npy per sprite, next to --save-array, with a manifest')
+    parser.add_argument('--sprite-gap', type=int, default=12,
+                        help='Largest gap in cells between two parts of the same sprite for --sprites')
+    parser.add_argument('--tile-cells', type=int,
+                        help='Extract very large images in tiles of this many cells per side (.npy inputs are '
+                             'memory-mapped and TIFF inputs read by region, other formats are decoded whole)')
+    parser.add_argument('--cache', help='Directory of a cache of extraction preprocessing, reused across runs')
+    parser.add_argument('--render-cache', help='Directory of a cache of rendered images, reused across runs')
+    parser.add_argument('--cache-size', type=int, default=512, help='Size limit of each cache in MB')
     parser.add_argument('--debug', '-d', action='store_true', help='Save debug images')
+    parser.add_argument('--debug-scale', type=float, default=1.0,
+                        help='Downscale factor of the debug images (e.g. 0.25 for quick previews)')
+    parser.add_argument('--debug-compression', type=int,
+                        help='PNG compression level of the debug images (0-9, default: OpenCV default)')
+
+    # Auto-tune options
+    parser.add_argument('--auto-tune', action='store_true',
+                        help='Search threshold, cell threshold, purple boost and block size for the input image')
+    parser.add_argument('--reference', help='Pixel array (.npy) the auto-tuned extraction should reproduce')
+    parser.add_argument('--workers', type=int, help='Number of auto-tune worker processes (default: one per CPU)')
 
     # Rendering options
     parser.add_argument('--pixel-size', '-p', type=int, help='Size of each pixel')
@@ -1059,6 +2160,10 @@ def main():
     parser.add_argument('--glow-color', help='Glow color (R,G,B format)', default='128,0,255')
     parser.add_argument('--glow-intensity', type=float, default=0.8, help='Intensity of glow (0-1)')
     parser.add_argument('--background', default='0,0,0', help='Background color (R,G,B format)')
+    parser.add_argument('--glow-mode', choices=['blur', 'distance'], default='blur',
+                        help='Blurred glow, or distance transform glow (same speed whatever the radius)')
+    parser.add_argument('--glow-falloff', choices=sorted(GLOW_FALLOFFS), default='gaussian',
+                        help='Falloff of the distance glow mode')
 
     # Editor options
     parser.add_argument('--visual-edit', '-v', action='store_true', help='Open visual interactive editor', default=True)
@@ -1075,14 +2180,88 @@ def main():
     glow_color = tuple(map(int, args.glow_color.split(',')) if args.glow_color else (128, 0, 255))
     bg_color = tuple(map(int, args.background.split(',')))
 
-    # Get pixel array (from input image, example, or loaded file)
-    if args.load_array:
-        print(f"Loading pixel array from: {args.load_array}")
-        if args.text_format:
-            pixel_array = load_array_from_text(args.load_array)
-        else:
-            pixel_array = load_pixel_array(args.load_array)
-        grid_size = args.grid_size or 30
+    # Search the extraction parameters first, the array is then extracted with the best ones
+    if args.auto_tune:
+        if not args.input:
+            parser.error("--auto-tune needs an --input image")
+        from autotune import auto_tune, print_results
+        print(f"Auto-tuning extraction of: {args.input}")
+        results = auto_tune(args.input, reference=args.reference, grid_size=args.grid_size,
+                            threshold=args.threshold, cell_threshold=args.cell_threshold,
+                            purple_boost=args.purple_boost, block_size=args.block_size,
+                            blob_detection=args.blob_detection, registration=args.registration,
+                            workers=args.workers)
+        print_results(results)
+        for name, value in results[0]['params'].items():
+            setattr(args, name, value)
+
+    # Debug images are encoded in the background while the extraction runs
+    debug = None
+    if args.debug:
+        debug = DebugImageWriter(compression=args.debug_compression, scale=args.debug_scale)
+
+    corners = None
+    if args.corners:
+        corners = [tuple(map(float, corner.split(','))) for corner in args.corners.split(';')]
+        if len(corners) != 4:
+            parser.error("--corners needs four x,y points")
+
+    cache = None
+    if args.cache:
+        from cache import PreprocessCache
+        cache = PreprocessCache(args.cache, max_bytes=args.cache_size * 1024 * 1024)
+
+    # Multi-color extraction has its own output, the binary editor and renderer do not apply
+    if args.palette:
+        if not args.input:
+            parser.error("--palette needs an --input image")
+        import json
+        print(f"Extracting a {args.palette} color palette array from: {args.input}")
+        index_array, palette, grid_size = extract_palette_array(
+            args.input,
+            n_colors=args.palette,
+            grid_size=args.grid_size,
+            robust=args.robust_color,
+            threshold=args.threshold,
+            cell_threshold=args.cell_threshold,
+            purple_boost=args.purple_boost,
+            blob_detection=args.blob_detection,
+            registration=args.registration,
+            block_size=args.block_size,
+            debug_output=debug
+        )
+        if debug:
+            debug.close()
+
+        np.save(args.save_array, index_array)
+        palette_path = os.path.splitext(args.save_array)[0] + '_palette.json'
+        with open(palette_path, 'w') as f:
+            json.dump({'grid_size': grid_size, 'shape': list(index_array.shape),
+                       'palette': palette.tolist()}, f, indent=4)
+        for index, color in enumerate(palette):
+            print(f"{index}: RGB{tuple(int(c) for c in color)} x {np.count_nonzero(index_array == index)} cells")
+        print(f"Saved index array to {args.save_array} and palette to {palette_path}")
+        return
+
+    # Get pixel array (from input image, example, or loaded file). An explicit --input or --example wins
+    # over --load-array, which always has a default
+    if args.input and args.tile_cells:
+        from tiled import extract_pixel_array_tiled
+        print(f"Analyzing image in tiles of {args.tile_cells} cells: {args.input}")
+        pixel_array, grid_size = extract_pixel_array_tiled(
+            args.input,
+            grid_size=args.grid_size,
+            threshold=args.threshold,
+            cell_threshold=args.cell_threshold,
+            purple_boost=args.purple_boost,
+            blob_detection=args.blob_detection,
+            registration=args.registration,
+            block_size=args.block_size,
+            tile_cells=args.tile_cells,
+            debug_output=debug
+        )
+        if debug:
+            debug.close()
     elif args.input:
         print(f"Analyzing image: {args.input}")
         pixel_array, grid_size = extract_pixel_array(
@@ -1092,24 +2271,62 @@ def main():
             cell_threshold=args.cell_threshold,
             purple_boost=args.purple_boost,
             blob_detection=args.blob_detection,
-            debug_output=args.debug
+            registration=args.registration,
+            block_size=args.block_size,
+            debug_output=debug,
+            cache=cache,
+            perspective=args.perspective,
+            corners=corners
         )
+        if debug:
+            debug.close()
     elif args.example:
         print("Creating example cat face")
         grid_size = args.grid_size or 30
         pixel_array = create_cat_face_array()
+    elif args.load_array:
+        print(f"Loading pixel array from: {args.load_array}")
+        if args.text_format:
+            pixel_array = load_array_from_text(args.load_array)
+        else:
+            pixel_array = load_pixel_array(args.load_array)
+        grid_size = args.grid_size or 30
     else:
         print("No input specified. Creating empty array.")
         grid_size = args.grid_size or 30
         pixel_array = create_empty_pixel_array(15, 20)
 
+    # A sprite sheet is saved as one array per sprite instead of being edited as a whole
+    if args.sprites:
+        if not args.input:
+            parser.error("--sprites needs an --input image")
+        sprites = split_sprites(pixel_array, gap=args.sprite_gap)
+        directory, filename = os.path.split(args.save_array)
+        manifest_path = save_sprites(sprites, directory or '.', os.path.splitext(filename)[0],
+                                     grid_size=grid_size, source=args.input)
+        for index, sprite in enumerate(sprites):
+            row, col, height, width = sprite['bbox']
+            print(f"Sprite {index}: {height}x{width} cells at ({row}, {col}), {sprite['cells']} lit")
+        print(f"Saved {len(sprites)} sprites with manifest {manifest_path}")
+        return
+
     # Show the array in the terminal
     print("\nCurrent pixel array:")
     display_array_in_terminal(pixel_array)
 
     # Interactive visual editor if requested
     if args.visual_edit:
-        pixel_array = create_interactive_editor(pixel_array, args.background_image)
+        # The preview has its own grid size, sizes given in output pixels are scaled to it
+        preview_grid_size = 10
+        scale = preview_grid_size / grid_size
+        preview_options = {'grid_size': preview_grid_size, 'glow_color': glow_color, 'background_color': bg_color,
+                           'glow_intensity': args.glow_intensity, 'glow_mode': args.glow_mode,
+                           'falloff': args.glow_falloff}
+        if args.pixel_size is not None:
+            preview_options['pixel_size'] = max(1, round(args.pixel_size * scale))
+        if args.glow_radius is not None:
+            preview_options['glow_radius'] = round(args.glow_radius * scale)
+        pixel_array = create_interactive_editor(pixel_array, args.background_image, preview_options)
 
     # Text-based editor if requested
     if args.text_edit:
@@ -1156,15 +2373,21 @@ def main():
         else:
             save_pixel_array(pixel_array, args.save_array)
 
-    # Render the image
-    result = render_pixel_image(
+    # Render the image, or reuse the render of the same array and settings
+    render = render_pixel_image
+    if args.render_cache:
+        from cache import RenderCache
+        render = RenderCache(args.render_cache, max_bytes=args.cache_size * 1024 * 1024).render
+    result = render(
         pixel_array,
         grid_size=grid_size,
         pixel_size=args.pixel_size,
         glow_radius=args.glow_radius,
         glow_color=glow_color,
         background_color=bg_color,
-        glow_intensity=args.glow_intensity
+        glow_intensity=args.glow_intensity,
+        glow_mode=args.glow_mode,
+        falloff=args.glow_falloff
     )
 
     # Save the rendered image
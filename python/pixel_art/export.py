@@ -0,0 +1,238 @@
+import numpy as np
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from cache import array_digest
+from editor import render_pixel_image
+
+
+def parse_frame(spec, default_duration=100):
+    """Path and duration in ms of a frame given as path or path:duration"""
+    path, _, duration = spec.rpartition(':')
+    if path and duration.isdigit():
+        return path, int(duration)
+    return spec, default_duration
+
+
+def _render_frame(pixel_array, render_options):
+    return render_pixel_image(pixel_array, as_array=True, **render_options)
+
+
+def render_frames(frames, workers=None, cache=None, **render_options):
+    """
+    Render pixel arrays on a process pool, each distinct array once.
+
+    Args:
+        frames: List of pixel arrays
+        workers: Number of worker processes (default: one per CPU)
+        cache: Optional RenderCache (see cache.py), only the renders it misses are computed
+        render_options: Arguments of render_pixel_image
+
+    Returns:
+        renders: List of the distinct uint8 RGBA renders
+        indices: Index in renders of every frame
+    """
+    # Identical frames share their render
+    keys = [array_digest(frame) for frame in frames]
+    unique = list(dict.fromkeys(keys))
+    first = {key: keys.index(key) for key in unique}
+
+    renders = [None] * len(unique)
+    cache_keys = []
+    if cache is not None:
+        cache_keys = [cache.key(frames[first[key]], **render_options) for key in unique]
+        renders = [cache.get(cache_key) for cache_key in cache_keys]
+    missing = [i for i, render in enumerate(renders) if render is None]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rendered = pool.map(_render_frame, [frames[first[unique[i]]] for i in missing],
+                                [render_options] * len(missing))
+            for i, render in zip(missing, rendered):
+                renders[i] = cache.put(cache_keys[i], render) if cache is not None else render
+    positions = {key: i for i, key in enumerate(unique)}
+    return renders, [positions[key] for key in keys]
+
+
+def _pad_to(render, width, height, background_color):
+    """Center a render on a canvas of the given size, so frames of different shapes can be animated"""
+    if render.shape[:2] == (height, width):
+        return render
+    canvas = np.empty((height, width, 4), dtype=np.uint8)
+    canvas[...] = (*background_color, 255)
+    y = (height - render.shape[0]) // 2
+    x = (width - render.shape[1]) // 2
+    canvas[y:y + render.shape[0], x:x + render.shape[1]] = render
+    return canvas
+
+
+def write_animation(renders, indices, durations, output_path, loop=0, background_color=(0, 0, 0)):
+    """Write an animated GIF or WebP, durations in ms"""
+    width = max(render.shape[1] for render in renders)
+    height = max(render.shape[0] for render in renders)
+    images = [Image.fromarray(_pad_to(render, width, height, background_color)[:, :, :3]) for render in renders]
+    sequence = [images[index] for index in indices]
+    sequence[0].save(output_path, save_all=True, append_images=sequence[1:], duration=durations, loop=loop)
+
+
+def write_video(renders, indices, durations, output_path, fps=30, background_color=(0, 0, 0)):
+    """
+    Write an MP4 through an ffmpeg pipe. Frames are repeated to last their duration at a constant fps,
+    the rounding is carried over so that the total length stays exact.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg was not found on the PATH, it is needed for video export")
+    width = max(render.shape[1] for render in renders)
+    height = max(render.shape[0] for render in renders)
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', output_path]
+
+    frames = [np.ascontiguousarray(_pad_to(render, width, height, background_color)[:, :, :3]).tobytes()
+              for render in renders]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    elapsed = 0
+    written = 0
+    try:
+        for index, duration in zip(indices, durations):
+            elapsed += duration
+            repeats = round(elapsed * fps / 1000) - written
+            for _ in range(repeats):
+                process.stdin.write(frames[index])
+            written += repeats
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}")
+
+
+def write_sprite_sheet(renders, indices, durations, output_path, names=None, columns=None):
+    """
+    Pack the distinct renders into a sprite sheet, with a JSON index of the frames next to it.
+
+    Renders go in a grid of cells of the largest render size. The index lists every frame in order with
+    the rectangle of its render in the sheet and its duration, frames with the same content share a rectangle.
+
+    Returns:
+        index_path: Path of the JSON index
+    """
+    cell_width = max(render.shape[1] for render in renders)
+    cell_height = max(render.shape[0] for render in renders)
+    if columns is None:
+        columns = math.ceil(math.sqrt(len(renders)))
+    rows = math.ceil(len(renders) / columns)
+
+    sheet = np.zeros((rows * cell_height, columns * cell_width, 4), dtype=np.uint8)
+    rects = []
+    for i, render in enumerate(renders):
+        y, x = (i // columns) * cell_height, (i % columns) * cell_width
+        sheet[y:y + render.shape[0], x:x + render.shape[1]] = render
+        rects.append({'x': x, 'y': y, 'w': render.shape[1], 'h': render.shape[0]})
+    Image.fromarray(sheet, 'RGBA').save(output_path)
+
+    entries = []
+    for i, (index, duration) in enumerate(zip(indices, durations)):
+        entry = dict(rects[index], duration=duration)
+        if names:
+            entry['name'] = names[i]
+        entries.append(entry)
+    index_path = os.path.splitext(output_path)[0] + '.json'
+    with open(index_path, 'w') as f:
+        json.dump({'image': os.path.basename(output_path), 'size': [sheet.shape[1], sheet.shape[0]],
+                   'frames': entries}, f, indent=4)
+    return index_path
+
+
+def export_animation(frames, durations, output_path, workers=None, fps=30, loop=0, cache=None, names=None,
+                     **render_options):
+    """
+    Render frames and write them as an animation, a video or a sprite sheet depending on the extension
+    of output_path: .gif or .webp, .mp4, or .png (sprite sheet with a .json index).
+
+    Args:
+        frames: List of pixel arrays, in order
+        durations: Duration of every frame in ms
+        output_path: Path of the output
+        workers: Number of render processes (default: one per CPU)
+        fps: Frame rate of videos
+        loop: Number of loops of GIF and WebP animations, 0 to loop forever
+        cache: Optional RenderCache reused across exports
+        names: Name of every frame, listed in the index of sprite sheets
+        render_options: Arguments of render_pixel_image
+
+    Returns:
+        rendered: Number of distinct frames
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension not in ('.gif', '.webp', '.mp4', '.png'):
+        raise ValueError(f"Unsupported export format: {extension}")
+
+    renders, indices = render_frames(frames, workers, cache, **render_options)
+    background_color = render_options.get('background_color', (0, 0, 0))
+    if extension in ('.gif', '.webp'):
+        write_animation(renders, indices, durations, output_path, loop, background_color)
+    elif extension == '.mp4':
+        write_video(renders, indices, durations, output_path, fps, background_color)
+    else:
+        write_sprite_sheet(renders, indices, durations, output_path, names)
+    return len(renders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export pixel array frames as an animation, a video or a sprite sheet')
+    parser.add_argument('frames', nargs='+', help='Pixel arrays (.npy) in order, as path or path:duration_ms')
+    parser.add_argument('--output', '-o', default='textures/animation.gif',
+                        help='Output path: .gif, .webp, .mp4 or .png (sprite sheet with a .json index)')
+    parser.add_argument('--duration', type=int, default=100, help='Duration of frames without one, in ms')
+    parser.add_argument('--fps', type=int, default=30, help='Frame rate of videos')
+    parser.add_argument('--loop', type=int, default=0, help='Number of loops of animations (0: forever)')
+    parser.add_argument('--workers', '-w', type=int, help='Number of render processes (default: one per CPU)')
+    parser.add_argument('--render-cache', help='Directory of a cache of rendered frames, reused across runs')
+    parser.add_argument('--cache-size', type=int, default=512, help='Size limit of the render cache in MB')
+    parser.add_argument('--grid-size', '-g', type=int, default=30, help='Size of each grid cell')
+    parser.add_argument('--pixel-size', '-p', type=int, help='Size of each pixel')
+    parser.add_argument('--glow-radius', '-r', type=int, help='Radius of the glow effect')
+    parser.add_argument('--glow-color', default='128,0,255', help='Glow color (R,G,B format)')
+    parser.add_argument('--glow-intensity', type=float, default=0.8, help='Intensity of glow (0-1)')
+    parser.add_argument('--background', default='0,0,0', help='Background color (R,G,B format)')
+    parser.add_argument('--glow-mode', choices=['blur', 'distance'], default='blur', help='Glow rendering')
+    args = parser.parse_args()
+
+    specs = [parse_frame(spec, args.duration) for spec in args.frames]
+    frames = [np.load(path) for path, _ in specs]
+    durations = [duration for _, duration in specs]
+    cache = None
+    if args.render_cache:
+        from cache import RenderCache
+        cache = RenderCache(args.render_cache, max_bytes=args.cache_size * 1024 * 1024)
+    rendered = export_animation(
+        frames,
+        durations,
+        args.output,
+        workers=args.workers,
+        fps=args.fps,
+        loop=args.loop,
+        cache=cache,
+        names=[os.path.splitext(os.path.basename(path))[0] for path, _ in specs],
+        grid_size=args.grid_size,
+        pixel_size=args.pixel_size,
+        glow_radius=args.glow_radius,
+        glow_color=tuple(map(int, args.glow_color.split(','))),
+        background_color=tuple(map(int, args.background.split(','))),
+        glow_intensity=args.glow_intensity,
+        glow_mode=args.glow_mode
+    )
+    print(f"Exported {len(frames)} frames ({rendered} distinct) to {args.output}")
+    if cache is not None:
+        print(f"Render cache: {cache.hits} hits, {cache.misses} misses")
+
+
+if __name__ == "__main__":
+    main()
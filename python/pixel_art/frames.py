@@ -0,0 +1,103 @@
+import numpy as np
+import argparse
+import os
+import time
+
+from PIL import Image
+
+from editor import changed_regions, render_pixel_image, render_pixel_region, render_reach
+
+
+def render_frame_set(frames, grid_size=30, base=0, **render_options):
+    """
+    Render frames of an animation that differ in a few cells.
+
+    The base frame is rendered once. Every other frame of the same shape is a copy of it, patched with
+    the re-rendered regions around the cells that differ from the base (see changed_regions), unless
+    rendering these regions with their halo costs more than rendering the whole frame.
+
+    Args:
+        frames: List of pixel arrays
+        grid_size: Size of each grid cell in the output images
+        base: Index of the frame the others are patched from
+        render_options: Other arguments of render_pixel_image
+
+    Returns:
+        images: List of PIL images, one per frame
+        rendered: Ratio of the output cells that were rendered, base frame included
+    """
+    reach = render_reach(grid_size, render_options.get('pixel_size'), render_options.get('glow_radius'),
+                         render_options.get('glow_mode', 'blur'))
+    base_image = render_pixel_image(frames[base], grid_size, as_array=True, **render_options)
+
+    images = []
+    rendered_cells = frames[base].size
+    total_cells = 0
+    for index, frame in enumerate(frames):
+        total_cells += frame.size
+        if index == base:
+            images.append(Image.fromarray(base_image, 'RGBA'))
+            continue
+        if frame.shape != frames[base].shape:
+            # Nothing to patch from
+            images.append(render_pixel_image(frame, grid_size, **render_options))
+            rendered_cells += frame.size
+            continue
+
+        regions = changed_regions(frame, frames[base], reach)
+        halo_cells = sum((rows.stop - rows.start + 2 * reach) * (cols.stop - cols.start + 2 * reach)
+                         for rows, cols in regions)
+        if halo_cells >= frame.size:
+            images.append(render_pixel_image(frame, grid_size, **render_options))
+            rendered_cells += frame.size
+            continue
+
+        image = base_image.copy()
+        for rows, cols in regions:
+            image[rows.start * grid_size:rows.stop * grid_size, cols.start * grid_size:cols.stop * grid_size] = \
+                render_pixel_region(frame, rows, cols, grid_size, reach, **render_options)
+            rendered_cells += (rows.stop - rows.start) * (cols.stop - cols.start)
+        images.append(Image.fromarray(image, 'RGBA'))
+
+    return images, rendered_cells / total_cells
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render the frames of an animation, patching them from a base frame')
+    parser.add_argument('frames', nargs='+', help='Pixel arrays (.npy) of the frames')
+    parser.add_argument('--output-dir', '-o', default='textures', help='Directory of the rendered images')
+    parser.add_argument('--base', type=int, default=0, help='Index of the frame the others are patched from')
+    parser.add_argument('--grid-size', '-g', type=int, default=30, help='Size of each grid cell')
+    parser.add_argument('--pixel-size', '-p', type=int, help='Size of each pixel')
+    parser.add_argument('--glow-radius', '-r', type=int, help='Radius of the glow effect')
+    parser.add_argument('--glow-color', default='128,0,255', help='Glow color (R,G,B format)')
+    parser.add_argument('--glow-intensity', type=float, default=0.8, help='Intensity of glow (0-1)')
+    parser.add_argument('--background', default='0,0,0', help='Background color (R,G,B format)')
+    parser.add_argument('--glow-mode', choices=['blur', 'distance'], default='blur', help='Glow rendering')
+    args = parser.parse_args()
+
+    frames = [np.load(path) for path in args.frames]
+    start = time.perf_counter()
+    images, rendered = render_frame_set(
+        frames,
+        grid_size=args.grid_size,
+        base=args.base,
+        pixel_size=args.pixel_size,
+        glow_radius=args.glow_radius,
+        glow_color=tuple(map(int, args.glow_color.split(','))),
+        background_color=tuple(map(int, args.background.split(','))),
+        glow_intensity=args.glow_intensity,
+        glow_mode=args.glow_mode
+    )
+    print(f"Rendered {len(images)} frames in {time.perf_counter() - start:.2f}s, "
+          f"{rendered:.1%} of the cells rendered")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for path, image in zip(args.frames, images):
+        output = os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0] + '.png')
+        image.save(output)
+        print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import numpy as np
 from PIL import Image, ImageDraw, ImageFilter
 import cv2
 import argparse
+from scipy.spatial import cKDTree
 
 
 def extract_pixel_array(image_path, grid_size=None, threshold=200, cell_threshold=0.3, debug_output=False):
@@ -51,27 +52,12 @@ def extract_pixel_array(image_path, grid_size=None, threshold=200, cell_threshol
                 centers.append((cx, cy))
 
         if len(centers) >= 2:
-            # Calculate pairwise distances between centers
-            distances = []
-            for i in range(len(centers)):
-                nearest_dists = []
-                for j in range(len(centers)):
-                    if i != j:
-                        x1, y1 = centers[i]
-                        x2, y2 = centers[j]
-                        dist = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-                        nearest_dists.append(dist)
-                if nearest_dists:
-                    # Use the minimum distance for each center
-                    nearest_dists.sort()
-                    distances.append(nearest_dists[0])
-
-            if distances:
-                # Use median of distances to be robust to outliers
-                grid_size = int(np.median(distances))
-            else:
-                # Default if we can't estimate properly
-                grid_size = min(width, height) // 10
+            # Nearest neighbour distance of each center, through a KD-tree query
+            points = np.array(centers, dtype=np.float64)
+            distances, _ = cKDTree(points).query(points, k=2)
+
+            # Use median of distances to be robust to outliers
+            grid_size = int(np.median(distances[:, 1]))
         else:
             # Default if we can't estimate
             grid_size = min(width, height) // 10
@@ -82,46 +68,30 @@ def extract_pixel_array(image_path, grid_size=None, threshold=200, cell_threshol
     grid_width = width // grid_size
     grid_height = height // grid_size
 
-    # Create empty grid
-    grid = np.zeros((grid_height, grid_width), dtype=int)
+    # Check each grid cell at once through a (grid_height, grid_size, grid_width, grid_size) view
+    cells = gray[:grid_height * grid_size, :grid_width * grid_size].reshape(
+        grid_height, grid_size, grid_width, grid_size)
 
-    # Create debug visualization if requested
+    # Check if each cell contains enough bright pixels
+    bright_ratio = np.count_nonzero(cells > threshold, axis=(1, 3)) / (grid_size * grid_size)
+    grid = (bright_ratio > cell_threshold).astype(int)
+
+    # Add grid visualization for debugging
     if debug_output:
         debug_img = img.copy()
-
-    # Check each grid cell
-    for y in range(grid_height):
-        for x in range(grid_width):
-            # Extract the region
-            cell_y_start = y * grid_size
-            cell_y_end = min((y + 1) * grid_size, height)
-            cell_x_start = x * grid_size
-            cell_x_end = min((x + 1) * grid_size, width)
-
-            cell = gray[cell_y_start:cell_y_end, cell_x_start:cell_x_end]
-
-            # Check if this cell contains enough bright pixels
-            bright_ratio = np.sum(cell > threshold) / cell.size
-            if bright_ratio > cell_threshold:
-                grid[y, x] = 1
-
-                # Add grid visualization for debugging
-                if debug_output:
-                    cv2.rectangle(debug_img,
-                                  (cell_x_start, cell_y_start),
-                                  (cell_x_end, cell_y_end),
-                                  (0, 255, 0), 2)
+        for y, x in zip(*np.nonzero(grid)):
+            x, y = int(x), int(y)
+            cv2.rectangle(debug_img,
+                          (x * grid_size, y * grid_size),
+                          ((x + 1) * grid_size, (y + 1) * grid_size),
+                          (0, 255, 0), 2)
 
     # Save debug visualizations if requested
     if debug_output:
         cv2.imwrite("debug_grid_detection.png", debug_img)
 
         # Create visualization of the detected grid
-        grid_vis = np.zeros((grid_height * 10, grid_width * 10), dtype=np.uint8)
-        for y in range(grid_height):
-            for x in range(grid_width):
-                if grid[y, x] == 1:
-                    grid_vis[y * 10:(y + 1) * 10, x * 10:(x + 1) * 10] = 255
+        grid_vis = np.repeat(np.repeat(grid.astype(np.uint8) * 255, 10, axis=0), 10, axis=1)
         cv2.imwrite("debug_detected_array.png", grid_vis)
 
     return grid, grid_size
@@ -2,6 +2,10 @@ import numpy as np
 import argparse
 import cv2
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Smallest grid size the glow textures are rendered at, below it the pixel and glow sizes round to nothing
+GLOW_GRID_SIZE = 16
 
 
 def remove_last_row_and_column(input_file, output_file=None):
@@ -104,14 +108,33 @@ def add_empty_columns(input_file, output_file=None):
     np.save(output_file, modified_array)
     print(f"Modified array saved to {output_file}")
 
-def npy_to_texture(input_file, output_file=None, scale=1):
+def texture_level_path(output_file, scale, first_scale, glow=False):
+    """Path of the texture of one level: output_file for the first level, <name>_x<scale>.png for the others"""
+    base_name = os.path.splitext(output_file)[0] + ("_glow" if glow else "")
+    if scale == first_scale:
+        return base_name + ".png"
+    return f"{base_name}_x{scale}.png"
+
+
+def npy_to_texture(input_file, output_file=None, scale=1, scales=None, glow_options=None):
     """
     Convert a NumPy array from a .npy file to a texture PNG format suitable for the shader.
 
+    With several scales, a chain of textures is written in one pass from the array, each level being the
+    array repeated at its integer scale (see texture_level_path for the file names). The metadata lists
+    every level, so the shader can pick the resolution it needs instead of upscaling.
+
     Args:
         input_file: Path to the input .npy file
         output_file: Path to save the PNG file (if None, will use input name with .png extension)
         scale: Scale factor for the output image (default: 1)
+        scales: Integer scale factors of a chain of textures (overrides scale)
+        glow_options: Arguments of render_pixel_image to also save a glow render of each level (None for no
+            glow render). The glow is rendered once with a grid size of the largest scale, and at least
+            GLOW_GRID_SIZE, then resampled to the size of each level
+
+    Returns:
+        paths: Paths of the written textures
     """
     # Load the array
     pixel_array = np.load(input_file)
@@ -124,18 +147,43 @@ def npy_to_texture(input_file, output_file=None, scale=1):
     image = np.zeros((height, width), dtype=np.uint8)
     image[pixel_array == 1] = 255
 
-    # Scale if needed
-    if scale > 1:
-        image = cv2.resize(image, (width * scale, height * scale),
-                           interpolation=cv2.INTER_NEAREST)
-
     # Determine output path
     if output_file is None:
         base_name = os.path.splitext(input_file)[0]
         output_file = f"{base_name}.png"
 
-    # Save as PNG
-    cv2.imwrite(output_file, image)
+    scales = sorted(set(scales or [scale]))
+    if glow_options is not None:
+        from editor import render_pixel_image
+        glow_grid_size = max(scales[-1], GLOW_GRID_SIZE)
+        glow = cv2.cvtColor(render_pixel_image(pixel_array, grid_size=glow_grid_size, as_array=True, **glow_options),
+                            cv2.COLOR_RGBA2BGRA)
+
+    levels = []
+    paths = []
+    for level_scale in scales:
+        # Each cell repeated level_scale times in both directions, in a single copy
+        level = np.broadcast_to(image[:, None, :, None], (height, level_scale, width, level_scale))
+        level_file = texture_level_path(output_file, level_scale, scales[0])
+        cv2.imwrite(level_file, level.reshape(height * level_scale, width * level_scale))
+        paths.append(level_file)
+        entry = {
+            "scale": level_scale,
+            "width": width * level_scale,
+            "height": height * level_scale,
+            "file": os.path.basename(level_file)
+        }
+
+        if glow_options is not None:
+            glow_file = texture_level_path(output_file, level_scale, scales[0], glow=True)
+            if level_scale == glow_grid_size:
+                cv2.imwrite(glow_file, glow)
+            else:
+                cv2.imwrite(glow_file, cv2.resize(glow, (width * level_scale, height * level_scale),
+                                                  interpolation=cv2.INTER_AREA))
+            paths.append(glow_file)
+            entry["glow_file"] = os.path.basename(glow_file)
+        levels.append(entry)
 
     # Also save metadata JSON
     metadata_file = os.path.splitext(output_file)[0] + "_meta.json"
@@ -144,11 +192,14 @@ def npy_to_texture(input_file, output_file=None, scale=1):
         json.dump({
             "width": width,
             "height": height,
-            "scale": scale
+            "scale": scales[0],
+            "levels": levels,
+            **({"glow_grid_size": glow_grid_size} if glow_options is not None else {})
         }, f)
 
-    print(f"Converted pixel array to texture at {output_file}")
+    print(f"Converted pixel array to {len(paths)} textures at {output_file}")
     print(f"Metadata saved to {metadata_file}")
+    return paths
 
 
 def add_empty_rows_at_bottom(input_file, output_file=None):
@@ -216,9 +267,103 @@ def remove_last_14_rows(input_file, output_file=None):
     np.save(output_file, modified_array)
     print(f"Modified array saved to {output_file}")
 
-if __name__ == "__main__":
-    #remove_last_row_and_column("npy/full_kerfur.npy", "npy/kerfur_final.npy")
-    #add_empty_columns("npy/kerfur_final.npy", "npy/kerfur_final2.npy")
 
-    add_empty_rows_at_bottom("npy/eyes_closed.npy", "npy/eyes_closed2.npy")
-    npy_to_texture("npy/eyes_closed2.npy", "textures/eyes_closed.png", 1)
+def _texture_outputs(input_file, input_dir, output_dir, scales, glow):
+    """Paths of the textures of every level, optional glow renders and metadata built from an .npy file"""
+    base_name = os.path.splitext(os.path.relpath(input_file, input_dir))[0]
+    texture = os.path.join(output_dir, base_name + ".png")
+    outputs = [texture_level_path(texture, scale, min(scales)) for scale in scales]
+    if glow:
+        outputs += [texture_level_path(texture, scale, min(scales), glow=True) for scale in scales]
+    outputs.append(os.path.join(output_dir, base_name + "_meta.json"))
+    return outputs
+
+
+def _is_up_to_date(input_file, outputs):
+    """True if every output exists and is newer than the input"""
+    source_time = os.path.getmtime(input_file)
+    return all(os.path.exists(path) and os.path.getmtime(path) >= source_time for path in outputs)
+
+
+def _build_texture(input_file, output_file, scales, glow_options):
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    npy_to_texture(input_file, output_file, scales=scales, glow_options=glow_options)
+    return input_file
+
+
+def build_textures(input_dir="npy", output_dir="textures", scales=(1,), glow=False, workers=None, force=False,
+                   **render_options):
+    """
+    Convert every .npy file under input_dir into textures and their metadata in output_dir, on a process pool.
+
+    Subdirectories are mirrored in output_dir. Files whose outputs are all newer than the .npy are skipped.
+
+    Args:
+        input_dir: Directory searched recursively for .npy files
+        output_dir: Directory of the textures
+        scales: Integer scale factors of the chain of textures of each array (see npy_to_texture)
+        glow: Also save a glow render of each level
+        workers: Number of worker processes (default: one per CPU)
+        force: Rebuild up to date textures too
+        render_options: Arguments of render_pixel_image for the glow renders, except grid_size (see
+                        npy_to_texture)
+
+    Returns:
+        built: Paths of the converted .npy files
+        skipped: Paths of the .npy files that were up to date
+    """
+    scales = sorted(set(scales))
+    input_files = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(input_dir)
+        for name in names if name.endswith(".npy")
+    )
+    jobs = []
+    skipped = []
+    for input_file in input_files:
+        outputs = _texture_outputs(input_file, input_dir, output_dir, scales, glow)
+        if not force and _is_up_to_date(input_file, outputs):
+            skipped.append(input_file)
+        else:
+            jobs.append((input_file, outputs[0]))
+
+    built = []
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_build_texture, input_file, output_file, scales, render_options if glow else None)
+                       for input_file, output_file in jobs]
+            built = [future.result() for future in futures]
+    return built, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert every pixel array (.npy) into shader textures')
+    parser.add_argument('--input-dir', '-i', default='npy', help='Directory searched for .npy files')
+    parser.add_argument('--output-dir', '-o', default='textures', help='Directory of the textures')
+    parser.add_argument('--scales', '-s', default='1', help='Scale factors of the chain of textures (e.g. 1,2,4,8)')
+    parser.add_argument('--workers', '-w', type=int, help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('--force', '-f', action='store_true', help='Rebuild textures that are up to date')
+    parser.add_argument('--glow', action='store_true',
+                        help='Also save a glow render of each level, resampled from one render at the largest scale '
+                             f'(at least {GLOW_GRID_SIZE})')
+    parser.add_argument('--glow-color', default='128,0,255', help='Glow color (R,G,B format)')
+    parser.add_argument('--glow-intensity', type=float, default=0.8, help='Intensity of glow (0-1)')
+    parser.add_argument('--glow-mode', choices=['blur', 'distance'], default='blur', help='Glow rendering')
+    args = parser.parse_args()
+
+    built, skipped = build_textures(
+        args.input_dir,
+        args.output_dir,
+        scales=list(map(int, args.scales.split(','))),
+        glow=args.glow,
+        workers=args.workers,
+        force=args.force,
+        glow_color=tuple(map(int, args.glow_color.split(','))),
+        glow_intensity=args.glow_intensity,
+        glow_mode=args.glow_mode
+    )
+    print(f"Built {len(built)} textures, {len(skipped)} up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import numpy as np
+import argparse
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from editor import render_pixel_region, render_reach
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png_band(rgba, level=6, last=False):
+    """
+    Filter and deflate a band of RGBA rows on its own (alpha is dropped), as a piece of the image data of a PNG.
+
+    Rows use the Sub filter. The band is raw deflate flushed to a byte boundary (finished for the last
+    band), so the pieces of consecutive bands concatenate into a single deflate stream.
+
+    Returns:
+        scanlines: The filtered rows, the zlib checksum of the image is computed over them
+        compressed: The deflated piece
+    """
+    height, width = rgba.shape[:2]
+    scanlines = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 0] = 1
+    pixels = scanlines[:, 1:].reshape(height, width, 3)
+    pixels[:, 0] = rgba[:, 0, :3]
+    np.subtract(rgba[:, 1:, :3], rgba[:, :-1, :3], out=pixels[:, 1:])
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(scanlines) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return scanlines, compressed
+
+
+class PngStreamWriter:
+    """
+    Write an RGB PNG one band of rows at a time, from the pieces of encode_png_band, in order.
+    Only the current band is ever in memory.
+    """
+
+    def __init__(self, path, width, height):
+        self.file = open(path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.file.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        self.checksum = zlib.adler32(b'')
+        self.header = b'\x78\x9c'
+
+    def write(self, scanlines, compressed):
+        """Append the piece of a band, bands must come in order"""
+        self.checksum = zlib.adler32(scanlines, self.checksum)
+        self.file.write(_png_chunk(b'IDAT', self.header + compressed))
+        self.header = b''
+
+    def close(self):
+        """Finish the zlib stream and the file, after the last band"""
+        self.file.write(_png_chunk(b'IDAT', struct.pack('>I', self.checksum)))
+        self.file.write(_png_chunk(b'IEND', b''))
+        self.file.close()
+
+
+def render_poster(pixel_array, output_path, grid_size=30, band_cells=None, workers=None, compression=6,
+                  **render_options):
+    """
+    Render a pixel array straight into a PNG or TIFF file, in horizontal bands of cells.
+
+    Each band is rendered with a halo of the cells its glow can come from (see render_reach), so the file
+    is identical to saving render_pixel_image, without the whole image ever being in memory. Bands are
+    rendered (and deflated, for PNG) on a thread pool, a few bands ahead of the one being written.
+
+    Args:
+        pixel_array: Binary numpy array where 1s represent pixels to draw, can be memory-mapped
+        output_path: Path of the output, .png or .tif/.tiff (uncompressed, needs tifffile)
+        grid_size: Size of each grid cell in the output image
+        band_cells: Number of rows of cells per band (default: about 512 pixel rows)
+        workers: Number of render threads (default: one per CPU)
+        compression: zlib level of the PNG (0-9)
+        render_options: Other arguments of render_pixel_image
+
+    Returns:
+        size: (width, height) of the written image
+    """
+    height, width = pixel_array.shape
+    if band_cells is None:
+        band_cells = max(512 // grid_size, 1)
+    reach = render_reach(grid_size, render_options.get('pixel_size'), render_options.get('glow_radius'),
+                         render_options.get('glow_mode', 'blur'))
+    bands = [slice(row, min(row + band_cells, height)) for row in range(0, height, band_cells)]
+    size = (width * grid_size, height * grid_size)
+
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension not in ('.png', '.tif', '.tiff'):
+        raise ValueError(f"Unsupported poster format: {extension}")
+    png = extension == '.png'
+
+    def render_band(index):
+        rows = bands[index]
+        rgba = render_pixel_region(pixel_array, rows, slice(0, width), grid_size, reach, **render_options)
+        if png:
+            return encode_png_band(rgba, compression, last=index == len(bands) - 1)
+        return np.ascontiguousarray(rgba[:, :, :3])
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def rendered_bands():
+            # Keep a few bands in flight, in order, so that memory stays bounded
+            pending = deque()
+            for index in range(len(bands)):
+                pending.append(pool.submit(render_band, index))
+                if len(pending) > workers + 1:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        if png:
+            writer = PngStreamWriter(output_path, *size)
+            try:
+                for scanlines, compressed in rendered_bands():
+                    writer.write(scanlines, compressed)
+            finally:
+                writer.close()
+        else:
+            import tifffile
+            tifffile.imwrite(output_path, rendered_bands(), shape=(size[1], size[0], 3), dtype=np.uint8,
+                             rowsperstrip=band_cells * grid_size, photometric='rgb')
+
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a pixel array into a very large image, in bands')
+    parser.add_argument('array', help='Pixel array (.npy), memory-mapped')
+    parser.add_argument('--output', '-o', default='poster.png', help='Output image (.png, .tif or .tiff)')
+    parser.add_argument('--band-cells', type=int, help='Rows of cells per band (default: about 512 pixel rows)')
+    parser.add_argument('--workers', '-w', type=int, help='Number of render threads (default: one per CPU)')
+    parser.add_argument('--compression', type=int, default=6, help='PNG compression level (0-9)')
+    parser.add_argument('--grid-size', '-g', type=int, default=30, help='Size of each grid cell')
+    parser.add_argument('--pixel-size', '-p', type=int, help='Size of each pixel')
+    parser.add_argument('--glow-radius', '-r', type=int, help='Radius of the glow effect')
+    parser.add_argument('--glow-color', default='128,0,255', help='Glow color (R,G,B format)')
+    parser.add_argument('--glow-intensity', type=float, default=0.8, help='Intensity of glow (0-1)')
+    parser.add_argument('--background', default='0,0,0', help='Background color (R,G,B format)')
+    parser.add_argument('--glow-mode', choices=['blur', 'distance'], default='blur', help='Glow rendering')
+    args = parser.parse_args()
+
+    pixel_array = np.load(args.array, mmap_mode='r')
+    start = time.perf_counter()
+    width, height = render_poster(
+        pixel_array,
+        args.output,
+        grid_size=args.grid_size,
+        band_cells=args.band_cells,
+        workers=args.workers,
+        compression=args.compression,
+        pixel_size=args.pixel_size,
+        glow_radius=args.glow_radius,
+        glow_color=tuple(map(int, args.glow_color.split(','))),
+        background_color=tuple(map(int, args.background.split(','))),
+        glow_intensity=args.glow_intensity,
+        glow_mode=args.glow_mode
+    )
+    print(f"Rendered {width}x{height} poster to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+import numpy as np
+import argparse
+import colorsys
+import contextlib
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+from scipy.signal import fftconvolve
+
+from editor import extract_palette_array, extract_pixel_array, render_pixel_image
+
+
+def random_case(seed):
+    """
+    Draw the parameters of one synthetic test image from its seed.
+
+    Returns:
+        params: Dict of the array shape and density, the render settings and the degradations
+    """
+    rng = np.random.default_rng(seed)
+    grid_size = int(rng.integers(12, 41))
+    hue = rng.random()
+    glow_color = tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue, rng.uniform(0.5, 1), 1))
+    return {
+        'seed': seed,
+        'shape': (int(rng.integers(8, 49)), int(rng.integers(8, 49))),
+        'density': float(rng.uniform(0.05, 0.5)),
+        'grid_size': grid_size,
+        'glow_radius': int(grid_size * rng.uniform(0.3, 1.2)),
+        'glow_color': glow_color,
+        'glow_intensity': float(rng.uniform(0.5, 1)),
+        'noise': float(rng.uniform(0, 20)),
+        'blur': float(rng.uniform(0, 2)),
+        'jitter': float(rng.uniform(0, 0.03)),
+    }
+
+
+def make_case(params):
+    """
+    Render the pixel array of a case and degrade it like a photo.
+
+    The render is padded by two cells, its corners are moved by up to jitter times its size
+    (perspective jitter), then it is blurred and gets gaussian noise.
+
+    Returns:
+        pixel_array: The random binary array that was rendered
+        img: The degraded BGR image
+    """
+    rng = np.random.default_rng([params['seed'], 1])
+    pixel_array = (rng.random(params['shape']) < params['density']).astype(int)
+    grid_size = params['grid_size']
+
+    rendered = render_pixel_image(pixel_array, grid_size=grid_size, glow_radius=params['glow_radius'],
+                                  glow_color=params['glow_color'], glow_intensity=params['glow_intensity'])
+    img = cv2.cvtColor(np.array(rendered.convert('RGB')), cv2.COLOR_RGB2BGR)
+    pad = 2 * grid_size
+    img = cv2.copyMakeBorder(img, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=0)
+
+    # Perspective jitter
+    height, width = img.shape[:2]
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    moved = corners + rng.uniform(-1, 1, (4, 2)).astype(np.float32) * params['jitter'] * min(width, height)
+    img = cv2.warpPerspective(img, cv2.getPerspectiveTransform(corners, moved), (width, height))
+
+    # Optics and sensor
+    if params['blur'] > 0:
+        img = cv2.GaussianBlur(img, (0, 0), params['blur'])
+    noise = rng.normal(0, params['noise'], img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    return pixel_array, img
+
+
+def _common_canvas(extracted, expected):
+    """
+    Both arrays on a common canvas, at the offset where their lit cells match best (the rendered images are
+    padded, so extracted arrays have extra rows and columns around the expected one).
+    """
+    correlation = fftconvolve((extracted > 0).astype(float), (expected[::-1, ::-1] > 0).astype(float), mode='full')
+    peak_y, peak_x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    offset_y, offset_x = peak_y - expected.shape[0] + 1, peak_x - expected.shape[1] + 1
+
+    top, left = min(0, offset_y), min(0, offset_x)
+    height = max(extracted.shape[0], offset_y + expected.shape[0]) - top
+    width = max(extracted.shape[1], offset_x + expected.shape[1]) - left
+    canvas_extracted = np.zeros((height, width), dtype=int)
+    canvas_expected = np.zeros((height, width), dtype=int)
+    canvas_extracted[-top:-top + extracted.shape[0], -left:-left + extracted.shape[1]] = extracted
+    canvas_expected[offset_y - top:offset_y - top + expected.shape[0],
+                    offset_x - left:offset_x - left + expected.shape[1]] = expected
+    return canvas_extracted, canvas_expected
+
+
+def cell_accuracy(extracted, expected):
+    """
+    Ratio of the expected cells that the extraction got right, at the offset where both arrays match best.
+    Lit cells extracted outside of the expected array count as errors too.
+    """
+    if extracted.size == 0:
+        return 0.0
+    canvas_extracted, canvas_expected = _common_canvas(extracted, expected)
+    errors = np.count_nonzero((canvas_extracted > 0) != (canvas_expected > 0))
+    return float(max(0.0, 1 - errors / expected.size))
+
+
+def palette_accuracy(extracted, expected):
+    """
+    Like cell_accuracy, for index arrays of several colors. Palette entries are ordered by brightness rather
+    than as rendered, so each extracted index stands for the expected index most of its cells have.
+    """
+    if extracted.size == 0:
+        return 0.0
+    canvas_extracted, canvas_expected = _common_canvas(extracted, expected)
+    table = np.zeros((canvas_extracted.max() + 1, canvas_expected.max() + 1), dtype=int)
+    np.add.at(table, (canvas_extracted, canvas_expected), 1)
+    mapping = np.argmax(table, axis=1)
+    mapping[0] = 0
+    errors = np.count_nonzero(mapping[canvas_extracted] != canvas_expected)
+    return float(max(0.0, 1 - errors / expected.size))
+
+
+def run_case(seed, extract_options=None, image_dir=None):
+    """
+    Generate one case, extract it back and measure the round trip.
+
+    Returns:
+        record: The case parameters with the accuracy, the detected grid size and the extraction wall time
+    """
+    params = random_case(seed)
+    pixel_array, img = make_case(params)
+    if image_dir:
+        cv2.imwrite(os.path.join(image_dir, f"case_{seed:06d}.png"), img)
+        np.save(os.path.join(image_dir, f"case_{seed:06d}.npy"), pixel_array)
+
+    record = dict(params)
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            extracted, grid_size = extract_pixel_array(img, **(extract_options or {}))
+        record['time'] = time.perf_counter() - start
+        record['found_grid_size'] = int(grid_size)
+        record['accuracy'] = cell_accuracy(extracted, pixel_array)
+        record['exact'] = record['accuracy'] == 1.0
+    except Exception as e:
+        record['time'] = time.perf_counter() - start
+        record['found_grid_size'] = None
+        record['accuracy'] = 0.0
+        record['exact'] = False
+        record['error'] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def run_corpus(count, first_seed=0, workers=None, extract_options=None, image_dir=None):
+    """
+    Run count cases on a process pool. Seeds are consecutive from first_seed, so any case can be replayed.
+
+    Returns:
+        records: One record per case (see run_case), in seed order
+    """
+    if image_dir:
+        os.makedirs(image_dir, exist_ok=True)
+    seeds = range(first_seed, first_seed + count)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_case, seed, extract_options, image_dir) for seed in seeds]
+        records = []
+        for i, future in enumerate(futures):
+            records.append(future.result())
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1}/{count} cases")
+    return records
+
+
+def glow_render(pixel_array, grid_size=16, shift=(0, 0), squeeze=1.0, **render_options):
+    """
+    BGR render of a pixel array by render_pixel_image, glow included, padded by two cells and moved by
+    shift (x, y) pixels (fractions of a pixel are interpolated).
+
+    Args:
+        squeeze: Width of the top edge of the panel relative to its bottom edge, as if seen at an angle
+
+    Returns:
+        img: The BGR image
+        corners: Corners of the panel (the rendered cells) in the image, clockwise from the top left
+    """
+    rendered = render_pixel_image(pixel_array, grid_size=grid_size, as_array=True, **render_options)
+    img = cv2.cvtColor(rendered, cv2.COLOR_RGBA2BGR)
+    pad = 2 * grid_size
+    img = cv2.copyMakeBorder(img, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=0)
+    height, width = img.shape[:2]
+    corners = np.float32([[pad, pad], [width - pad, pad], [width - pad, height - pad], [pad, height - pad]])
+
+    inset = (1 - squeeze) / 2 * (width - 2 * pad)
+    moved = corners + np.float32([[inset + shift[0], shift[1]], [-inset + shift[0], shift[1]],
+                                  [shift[0], shift[1]], [shift[0], shift[1]]])
+    if (moved != corners).any():
+        img = cv2.warpPerspective(img, cv2.getPerspectiveTransform(corners, moved), (width, height))
+    return img, moved
+
+
+def palette_render(index_array, colors, grid_size=16, **render_options):
+    """
+    BGR render of an index array with one glow color per index (index 0 is the background), padded like
+    glow_render. Each color is rendered by render_pixel_image and the renders are merged by their
+    per-channel maximum, so that overlapping glows tint each other without clipping to white.
+
+    """
+    merged = None
+    for index, color in enumerate(colors, start=1):
+        rendered = render_pixel_image((index_array == index).astype(int), grid_size=grid_size, glow_color=color,
+                                      as_array=True, **render_options)
+        merged = rendered if merged is None else np.maximum(merged, rendered)
+    pad = 2 * grid_size
+    return cv2.copyMakeBorder(cv2.cvtColor(merged, cv2.COLOR_RGBA2BGR), pad, pad, pad, pad, cv2.BORDER_CONSTANT,
+                              value=0)
+
+
+# Round trips of the renderer's own output that must stay exact, with the given render and extraction options.
+# With 'corners', the panel corners are passed to the extraction
+REGRESSION_CASES = [
+    {'name': 'glow', 'grid_size': 16},
+    {'name': 'glow_shifted', 'grid_size': 16, 'shift': (5, 7)},
+    {'name': 'glow_subpixel_shift', 'grid_size': 24, 'shift': (10.5, 3.25)},
+    {'name': 'glow_wide_radius', 'grid_size': 20, 'render': {'glow_radius': 30}},
+    {'name': 'glow_perspective_corners', 'grid_size': 16, 'squeeze': 0.8, 'corners': True},
+    {'name': 'glow_perspective_panel', 'grid_size': 16, 'squeeze': 0.8,
+     'render': {'background_color': (45, 40, 50)}, 'extract': {'perspective': True}},
+]
+
+# Round trips of multi-colored renders through extract_palette_array, with the density of lit cells
+PALETTE_CASES = [
+    {'name': 'palette_sparse', 'grid_size': 16, 'density': 0.1, 'render': {'glow_radius': 8},
+     'colors': [(255, 40, 40), (40, 255, 60), (60, 120, 255)]},
+    {'name': 'palette_dense', 'grid_size': 16, 'density': 0.3, 'render': {'glow_radius': 4},
+     'colors': [(255, 40, 40), (40, 255, 60), (60, 120, 255)]},
+]
+
+
+def run_regression(cases=REGRESSION_CASES, seeds=range(4)):
+    """
+    Extract every regression case back from renders of random arrays of a few seeds.
+
+    Returns:
+        records: One record per case and seed, with the accuracy and the detected grid size
+    """
+    records = []
+    for case in cases:
+        for seed in seeds:
+            pixel_array = (np.random.default_rng([seed, 2]).random((24, 32)) < 0.3).astype(int)
+            img, corners = glow_render(pixel_array, case['grid_size'], case.get('shift', (0, 0)),
+                                       case.get('squeeze', 1.0), **case.get('render', {}))
+            extract_options = dict(case.get('extract', {}))
+            if case.get('corners'):
+                extract_options['corners'] = corners
+            with contextlib.redirect_stdout(io.StringIO()):
+                extracted, grid_size = extract_pixel_array(img, **extract_options)
+            accuracy = cell_accuracy(extracted, pixel_array)
+            records.append({'name': case['name'], 'seed': seed, 'accuracy': accuracy,
+                            'found_grid_size': int(grid_size), 'passed': accuracy == 1.0})
+    return records
+
+
+def run_palette_regression(cases=PALETTE_CASES, seeds=range(4)):
+    """
+    Extract every palette case back from renders of random index arrays of a few seeds.
+
+    Returns:
+        records: One record per case and seed, like run_regression
+    """
+    records = []
+    for case in cases:
+        colors = case['colors']
+        for seed in seeds:
+            rng = np.random.default_rng([seed, 3])
+            lit = rng.random((24, 32)) < case['density']
+            index_array = np.where(lit, rng.integers(1, len(colors) + 1, lit.shape), 0)
+            img = palette_render(index_array, colors, case['grid_size'], **case.get('render', {}))
+            with contextlib.redirect_stdout(io.StringIO()):
+                extracted, _, grid_size = extract_palette_array(img, n_colors=len(colors) + 1,
+                                                                **case.get('extract', {}))
+            accuracy = palette_accuracy(extracted, index_array)
+            records.append({'name': case['name'], 'seed': seed, 'accuracy': accuracy,
+                            'found_grid_size': int(grid_size), 'passed': accuracy == 1.0})
+    return records
+
+
+def summarize(records):
+    """Aggregate accuracy and wall time of the records"""
+    accuracy = np.array([r['accuracy'] for r in records])
+    times = np.array([r['time'] for r in records])
+    return {
+        'cases': len(records),
+        'mean_accuracy': float(accuracy.mean()),
+        'exact_rate': float(np.mean([r['exact'] for r in records])),
+        'grid_size_rate': float(np.mean([r['found_grid_size'] == r['grid_size'] for r in records])),
+        'errors': sum('error' in r for r in records),
+        'time_median': float(np.median(times)),
+        'time_p95': float(np.percentile(times, 95)),
+        'time_total': float(times.sum()),
+        'worst_seeds': [r['seed'] for r in sorted(records, key=lambda r: r['accuracy'])[:10]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Round-trip stress test of the pixel array extraction')
+    parser.add_argument('--count', '-n', type=int, default=1000, help='Number of synthetic images')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first image')
+    parser.add_argument('--workers', '-w', type=int, help='Number of worker processes (default: one per CPU)')
+    parser.add_argument('--output', '-o', default='stress.json', help='Path of the JSON report')
+    parser.add_argument('--save-images', help='Also keep the generated images and arrays in this directory')
+    parser.add_argument('--no-registration', dest='registration', action='store_false',
+                        help='Extract without grid registration')
+    parser.add_argument('--regression', action='store_true',
+                        help='Only run the fixed round trips of REGRESSION_CASES and PALETTE_CASES, exit with an error '
+                             'if one fails')
+    args = parser.parse_args()
+
+    if args.regression:
+        records = run_regression() + run_palette_regression()
+        for record in records:
+            status = 'ok' if record['passed'] else 'FAILED'
+            print(f"{record['name']} (seed {record['seed']}): accuracy {record['accuracy']:.4f}, "
+                  f"grid size {record['found_grid_size']} {status}")
+        failed = sum(not record['passed'] for record in records)
+        print(f"{len(records) - failed}/{len(records)} regression cases passed")
+        raise SystemExit(1 if failed else 0)
+
+    records = run_corpus(args.count, args.seed, args.workers,
+                         extract_options={'registration': args.registration}, image_dir=args.save_images)
+    summary = summarize(records)
+    with open(args.output, 'w') as f:
+        json.dump({'summary': summary, 'records': records}, f, indent=1)
+
+    print(f"{summary['cases']} cases: mean accuracy {summary['mean_accuracy']:.4f}, "
+          f"exact {summary['exact_rate']:.1%}, grid size found {summary['grid_size_rate']:.1%}, "
+          f"{summary['errors']} errors")
+    print(f"Extraction time: median {summary['time_median'] * 1000:.0f} ms, p95 {summary['time_p95'] * 1000:.0f} ms")
+    print(f"Worst seeds: {summary['worst_seeds']}")
+    print(f"Report saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import numpy as np
+import cv2
+from collections import OrderedDict
+
+from editor import align_to_grid, classify_cells, compute_pixel_scores, locate_grid
+
+
+class TiffRegions:
+    """
+    Read-only view of a TIFF image as a BGR uint8 array, that only decodes the strips or tiles covered by
+    the regions read from it. Decoded segments are kept in a cache of up to cache_bytes, so reading the
+    tiles of a row one after the other decodes each strip once.
+
+    Only the shape, dtype and [rows, cols] slicing of an array are supported, which is what the tiled
+    extraction uses.
+    """
+
+    def __init__(self, path, cache_bytes=256 * 1024 * 1024):
+        """
+        Args:
+            path: Path of a TIFF file with interleaved 8 or 16 bit gray, RGB or RGBA samples
+            cache_bytes: Size of the cache of decoded strips or tiles
+
+        Raises:
+            ValueError: When the layout of the file is not supported, it can still be decoded whole
+        """
+        import tifffile
+        self._tiff = tifffile.TiffFile(path)
+        page = self._tiff.pages.first
+        if (page.planarconfig != 1 and page.samplesperpixel > 1) or page.samplesperpixel not in (1, 3, 4) \
+                or page.dtype not in (np.uint8, np.uint16) or page.imagedepth > 1:
+            self._tiff.close()
+            raise ValueError(f"Unsupported TIFF layout: {path}")
+        self._page = page
+        self.shape = (page.imagelength, page.imagewidth, 3)
+        self.dtype = np.dtype(np.uint8)
+        if page.is_tiled:
+            self._segment_shape = (page.tilelength, page.tilewidth)
+        else:
+            self._segment_shape = (min(page.rowsperstrip, page.imagelength), page.imagewidth)
+        self._segments_per_row = -(-page.imagewidth // self._segment_shape[1])
+        self._cache = OrderedDict()
+        self._cache_used = 0
+        self.cache_bytes = cache_bytes
+
+    def _segment(self, index):
+        """BGR pixels of a strip or tile"""
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+
+        page = self._page
+        handle = self._tiff.filehandle
+        handle.seek(page.dataoffsets[index])
+        data = handle.read(page.databytecounts[index])
+        segment = page.decode(data, index, jpegtables=page.jpegtables)[0]
+        if segment is None:
+            segment = np.zeros(self._segment_shape + (3,), np.uint8)
+        else:
+            # (length, width, samples), the last strip may be shorter than the others
+            segment = segment.reshape(segment.shape[-3:])
+            if segment.dtype == np.uint16:
+                segment = (segment >> 8).astype(np.uint8)
+            if segment.shape[2] == 1:
+                segment = cv2.cvtColor(segment, cv2.COLOR_GRAY2BGR)
+            else:
+                segment = np.ascontiguousarray(segment[:, :, 2::-1])
+
+        self._cache[index] = segment
+        self._cache_used += segment.nbytes
+        while self._cache_used > self.cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_used -= evicted.nbytes
+        return segment
+
+    def __getitem__(self, key):
+        rows, cols = key
+        y0, y1, _ = rows.indices(self.shape[0])
+        x0, x1, _ = cols.indices(self.shape[1])
+        region = np.empty((max(y1 - y0, 0), max(x1 - x0, 0), 3), np.uint8)
+        if region.size == 0:
+            return region
+
+        segment_height, segment_width = self._segment_shape
+        for segment_row in range(y0 // segment_height, (y1 - 1) // segment_height + 1):
+            for segment_col in range(x0 // segment_width, (x1 - 1) // segment_width + 1):
+                segment = self._segment(segment_row * self._segments_per_row + segment_col)
+                top, left = segment_row * segment_height, segment_col * segment_width
+                sy0, sy1 = max(y0, top), min(y1, top + segment_height)
+                sx0, sx1 = max(x0, left), min(x1, left + segment_width)
+                region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = segment[sy0 - top:sy1 - top, sx0 - left:sx1 - left]
+        return region
+
+    def close(self):
+        self._tiff.close()
+
+
+def open_image(image):
+    """
+    Open an image without decoding it all when possible: arrays are used as they are, .npy files are
+    memory-mapped and TIFF files are read through TiffRegions, so tiles are only read from disk when they
+    are processed. Other formats (PNG, JPEG...) have no random access and are decoded whole with OpenCV,
+    convert very large ones to TIFF or .npy first.
+    """
+    if isinstance(image, (np.ndarray, TiffRegions)):
+        return image
+    if image.endswith('.npy'):
+        return np.load(image, mmap_mode='r')
+    if image.lower().endswith(('.tif', '.tiff')):
+        try:
+            return TiffRegions(image)
+        except ValueError:
+            pass
+    img = cv2.imread(image)
+    if img is None:
+        raise ValueError(f"Could not load image: {image}")
+    return img
+
+
+def extend_lattice(lattice, offset, image_shape, edge_slack=0.25):
+    """
+    Extend a lattice registered on a crop of an image to the whole image.
+
+    Args:
+        lattice: Result of register_grid on the crop
+        offset: (x, y) position of the crop in the image
+        image_shape: Shape of the whole image
+        edge_slack: Fraction of a cell that may stick out of the image, like in register_grid
+
+    Returns:
+        lattice: The same lattice, with origin and shape covering the whole image
+    """
+    grid_size = lattice['grid_size']
+    cell_vectors = lattice['transform'][:, :2] * grid_size
+    origin = lattice['transform'][:, 2] + offset
+
+    # Image corners in cells from the origin, the range of whole cells covering them
+    height, width = image_shape[:2]
+    corners = np.array([[0, 0], [0, height - 1], [width - 1, 0], [width - 1, height - 1]], dtype=np.float64)
+    cell_coords = (corners - origin) @ np.linalg.inv(cell_vectors).T
+    first = np.ceil(cell_coords.min(axis=0) - edge_slack).astype(int)
+    last = np.floor(cell_coords.max(axis=0) + edge_slack - (grid_size - 1) / grid_size).astype(int)
+    cols, rows = last - first + 1
+
+    origin = origin + cell_vectors @ first
+    return dict(lattice, origin=(origin[0], origin[1]), shape=(rows, cols),
+                transform=np.hstack([cell_vectors / grid_size, origin[:, None]]))
+
+
+def _read_tile(img, lattice, grid_size, rows, cols):
+    """Aligned pixels of the cells in the rows and cols ranges, read from the smallest region of the image"""
+    if lattice is None:
+        tile = img[rows.start * grid_size:rows.stop * grid_size, cols.start * grid_size:cols.stop * grid_size]
+        return np.ascontiguousarray(tile)
+
+    # Source region of the tile, with a margin for the interpolation
+    transform = lattice['transform']
+    u = np.array([cols.start, cols.stop, cols.start, cols.stop]) * grid_size
+    v = np.array([rows.start, rows.start, rows.stop, rows.stop]) * grid_size
+    source = transform[:, :2] @ np.array([u, v]) + transform[:, 2:]
+    x0, y0 = np.maximum(np.floor(source.min(axis=1)).astype(int) - 2, 0)
+    x1, y1 = np.ceil(source.max(axis=1)).astype(int) + 2
+    region = np.ascontiguousarray(img[y0:y1, x0:x1])
+    tile_shape = ((rows.stop - rows.start) * grid_size, (cols.stop - cols.start) * grid_size) + img.shape[2:]
+    if region.size == 0:
+        # Cells of a rotated grid sticking out of the image corners are black
+        return np.zeros(tile_shape, dtype=img.dtype)
+
+    # The same lattice, seen from the region and starting at the first cell of the tile
+    tile_origin = transform[:, :2] @ np.array([u[0], v[0]]) + transform[:, 2] - [x0, y0]
+    tile_lattice = dict(lattice, shape=(rows.stop - rows.start, cols.stop - cols.start),
+                        transform=np.hstack([transform[:, :2], tile_origin[:, None]]))
+    return align_to_grid(region, tile_lattice)
+
+
+def extract_pixel_array_tiled(image, grid_size=None, threshold=170, cell_threshold=0.15,
+                              purple_boost=True, blob_detection=True, registration=True, block_size=35,
+                              tile_cells=64, locate_size=2048, debug_output=False):
+    """
+    Extract a binary pixel array from a very large image, one tile at a time.
+
+    The grid is located on a central crop of locate_size pixels, then the image is processed in tiles of
+    tile_cells x tile_cells cells. Tiles follow cell boundaries and cells are classified independently
+    of their neighbours, so tiles need no overlap and their results are copied into the global grid.
+    Peak memory is a few tiles, plus the image itself unless it is memory-mapped or a TIFF (see open_image).
+
+    Args:
+        image: Path to the input image (.npy files are memory-mapped, TIFF files read by region), or a BGR
+               array or memory map
+        grid_size, threshold, cell_threshold, purple_boost, blob_detection, registration, block_size:
+            See extract_pixel_array
+        tile_cells: Number of cells along each side of a tile
+        locate_size: Size of the central crop the grid is located on
+        debug_output: Save the debug images of locating the grid on the crop
+
+    Returns:
+        pixel_array: Binary numpy array where 1s represent detected pixels
+        grid_size: The grid size used for the array
+    """
+    img = open_image(image)
+    height, width = img.shape[:2]
+
+    # Locate the grid on a central crop, then extend it to the whole image
+    y0 = max((height - locate_size) // 2, 0)
+    x0 = max((width - locate_size) // 2, 0)
+    crop = np.ascontiguousarray(img[y0:y0 + locate_size, x0:x0 + locate_size])
+    _, grid_size, lattice = locate_grid(crop, grid_size, threshold, purple_boost, blob_detection,
+                                        registration, debug_output, block_size, return_lattice=True)
+    del crop
+    if lattice is not None:
+        lattice = extend_lattice(lattice, (x0, y0), img.shape)
+        grid_height, grid_width = lattice['shape']
+    else:
+        grid_height, grid_width = height // grid_size, width // grid_size
+    print(f"Using grid size: {grid_size} pixels, {grid_height}x{grid_width} cells")
+
+    grid = np.zeros((grid_height, grid_width), dtype=int)
+    for row in range(0, grid_height, tile_cells):
+        rows = slice(row, min(row + tile_cells, grid_height))
+        for col in range(0, grid_width, tile_cells):
+            cols = slice(col, min(col + tile_cells, grid_width))
+            tile = _read_tile(img, lattice, grid_size, rows, cols)
+            score, gray = compute_pixel_scores(tile, purple_boost)
+            grid[rows, cols] = classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost)
+
+    if isinstance(img, TiffRegions) and img is not image:
+        img.close()
+    return grid, grid_size
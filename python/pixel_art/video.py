@@ -0,0 +1,164 @@
+import numpy as np
+import argparse
+import cv2
+import os
+
+from editor import align_to_grid, block_view, classify_cells, compute_pixel_scores, locate_grid
+
+
+def _resize_frames_file(path, frames):
+    """
+    Change the number of frames of a (T, H, W) .npy file in place: the header is rewritten with the new
+    shape, padded to its previous length, and the file is grown or truncated to match.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order,
+                       'shape': (frames,) + shape[1:]})
+        header_start = len(np.lib.format.magic(*version)) + (2 if version == (1, 0) else 4)
+        header = header.ljust(data_offset - header_start - 1) + '\n'
+        if len(header) != data_offset - header_start:
+            raise ValueError(f"Frame count {frames} does not fit in the header of {path}")
+
+        f.seek(header_start)
+        f.write(header.encode('latin1'))
+        f.truncate(data_offset + frames * int(np.prod(shape[1:])) * dtype.itemsize)
+
+
+def extract_video(video_path, output_path, grid_size=None, threshold=170, cell_threshold=0.15,
+                  purple_boost=True, blob_detection=True, registration=True, block_size=35,
+                  delta=4.0, max_frames=None):
+    """
+    Extract a pixel array from every frame of a video, into a (frames, height, width) .npy file.
+
+    The grid is located on the first frame only, every following frame is aligned with the same lattice.
+    A cell is only classified again when its mean color moved by more than delta since it was last
+    classified, the other cells keep their previous value. Frames are written to a memory-mapped .npy
+    as they are decoded, so the output never has to fit in memory.
+
+    Args:
+        video_path: Path to the input video
+        output_path: Path of the output .npy file
+        grid_size, threshold, cell_threshold, purple_boost, blob_detection, registration, block_size:
+            See extract_pixel_array
+        delta: Change of the mean color of a cell (0-255, on any channel) that triggers its re-classification,
+               0 to classify every cell that changed at all
+        max_frames: Stop after this many frames
+
+    Returns:
+        frames: Read-only memory map of the extracted (frames, height, width) array
+        grid_size: The grid size used for the arrays
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+
+    ok, frame = capture.read()
+    if not ok:
+        raise ValueError(f"Could not decode a frame from: {video_path}")
+
+    # Locate the grid once, on the first frame
+    frame, grid_size, lattice = locate_grid(frame, grid_size, threshold, purple_boost, blob_detection,
+                                            registration, block_size=block_size, return_lattice=True)
+    print(f"Using grid size: {grid_size} pixels")
+    grid_height, grid_width = frame.shape[0] // grid_size, frame.shape[1] // grid_size
+    cropped = (slice(0, grid_height * grid_size), slice(0, grid_width * grid_size))
+
+    # Frame count reported by the container, can be missing or wrong, the file is resized as needed
+    capacity = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    if capacity <= 0:
+        capacity = 256
+    if max_frames is not None:
+        capacity = min(capacity, max_frames)
+    frames = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8,
+                                       shape=(capacity, grid_height, grid_width))
+
+    # Classify the first frame completely
+    score, gray = compute_pixel_scores(frame, purple_boost)
+    grid = classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost).astype(np.uint8)
+    cell_colors = cv2.resize(frame[cropped], (grid_width, grid_height), interpolation=cv2.INTER_AREA)
+    classified_colors = cell_colors.astype(np.int16)
+    frames[0] = grid
+
+    count = 1
+    reclassified = 0
+    while max_frames is None or count < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if lattice is not None:
+            frame = align_to_grid(frame, lattice)
+
+        # Mean color of every cell, cheap next to classifying all of them
+        cell_colors = cv2.resize(frame[cropped], (grid_width, grid_height),
+                                 interpolation=cv2.INTER_AREA).astype(np.int16)
+        changed = np.abs(cell_colors - classified_colors).max(axis=2) > delta
+        rows, cols = np.nonzero(changed)
+
+        if len(rows):
+            # Stack the changed cells in a single column, so they classify like a regular grid
+            cells = block_view(frame, grid_size)[rows, :, cols, :]
+            column = np.ascontiguousarray(cells.reshape(len(rows) * grid_size, grid_size, 3))
+            score, gray = compute_pixel_scores(column, purple_boost)
+            grid[rows, cols] = classify_cells(score, gray, grid_size, threshold, cell_threshold, purple_boost)[:, 0]
+            classified_colors[rows, cols] = cell_colors[rows, cols]
+            reclassified += len(rows)
+
+        # Grow the output when the container under-reported its frame count
+        if count == capacity:
+            frames.flush()
+            del frames
+            capacity *= 2
+            _resize_frames_file(output_path, capacity)
+            frames = np.load(output_path, mmap_mode='r+')
+
+        frames[count] = grid
+        count += 1
+        if count % 100 == 0:
+            print(f"Frame {count}: {reclassified / ((count - 1) * grid.size):.1%} of cells reclassified")
+
+    capture.release()
+    frames.flush()
+    del frames
+    if count != capacity:
+        _resize_frames_file(output_path, count)
+
+    print(f"Extracted {count} frames of {grid_height}x{grid_width} cells to {output_path}")
+    return np.load(output_path, mmap_mode='r'), grid_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract a pixel array from every frame of a video')
+    parser.add_argument('video', help='Input video path')
+    parser.add_argument('--output', '-o', help='Output .npy path (default: next to the video)')
+    parser.add_argument('--grid-size', '-g', type=int, help='Grid size to use (default: auto-detect)')
+    parser.add_argument('--threshold', '-t', type=int, default=170,
+                        help='Brightness threshold (0-255, lower value for purple glow)')
+    parser.add_argument('--cell-threshold', '-c', type=float, default=0.15,
+                        help='Ratio of bright pixels needed in a cell')
+    parser.add_argument('--no-purple-boost', dest='purple_boost', action='store_false',
+                        help='Classify cells on plain brightness')
+    parser.add_argument('--no-registration', dest='registration', action='store_false',
+                        help='Skip grid registration from the image spectrum (pitch, offset and rotation)')
+    parser.add_argument('--block-size', type=int, default=35,
+                        help='Neighborhood size (odd) of the adaptive threshold used to estimate the grid size')
+    parser.add_argument('--delta', type=float, default=4.0,
+                        help='Change of the mean color of a cell that triggers its re-classification')
+    parser.add_argument('--max-frames', type=int, help='Stop after this many frames')
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.video)[0] + '.npy'
+    extract_video(args.video, output, grid_size=args.grid_size, threshold=args.threshold,
+                  cell_threshold=args.cell_threshold, purple_boost=args.purple_boost,
+                  registration=args.registration, block_size=args.block_size,
+                  delta=args.delta, max_frames=args.max_frames)
+
+
+if __name__ == "__main__":
+    main()
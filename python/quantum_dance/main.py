@@ -156,6 +156,44 @@ class Schrodinger(object):
         assert wave_fn.shape == self.x.shape
         return np.sqrt((abs(wave_fn) ** 2).sum() * 2 * np.pi / self.dx)
 
+    def get_state(self):
+        """
+        Returns the full solver state as a dict of arrays, suitable for
+        np.savez, so that a long run can be resumed exactly where it stopped.
+        """
+        state = dict(psi_mod_x=self.psi_mod_x,
+                     t=self.t,
+                     has_dt=self.dt_ is not None)
+        if self.dt_ is not None:
+            state.update(dt_=self.dt_,
+                         x_evolve_half=self.x_evolve_half,
+                         x_evolve=self.x_evolve,
+                         k_evolve=self.k_evolve)
+        return state
+
+    def set_state(self, state):
+        """
+        Restore a solver state returned by get_state.
+        Parameters
+        ----------
+        state : dict or NpzFile
+            The arrays returned by get_state, possibly reloaded from disk
+        """
+        assert state['psi_mod_x'].shape == self.x.shape
+        self.psi_mod_x = np.array(state['psi_mod_x'])
+        self.t = np.asarray(state['t']).item()
+        if state['has_dt']:
+            self.dt_ = np.asarray(state['dt_']).item()
+            self.x_evolve_half = np.array(state['x_evolve_half'])
+            self.x_evolve = np.array(state['x_evolve'])
+            self.k_evolve = np.array(state['k_evolve'])
+        else:
+            self.dt_ = None
+            self.x_evolve_half = None
+            self.x_evolve = None
+            self.k_evolve = None
+        self.compute_k_from_x()
+
     def solve(self, dt, Nsteps=1, eps=1e-3, max_iter=1000):
         """
         Propagate the Schrodinger equation forward in imaginary
@@ -252,6 +290,100 @@ def square_barrier(x, width, height):
     return height * (theta(x) - theta(x - width))
 
 
+######################################################################
+# Phase-space functions for the art
+
+def wigner_index_table(N, n_x, n_lag, lag_step=1):
+    """
+    Precompute the gather table of a (decimated) Wigner transform.
+    Parameters
+    ----------
+    N : int
+        Length of the wave function
+    n_x : int
+        Number of positions, evenly spread over the N samples
+    n_lag : int
+        Number of lags per position, this is also the number of momenta
+    lag_step : int
+        Stride between two lags, in samples. The momentum range covered
+        is +/- pi / (2 * lag_step * dx) (default = 1)
+
+    Returns
+    -------
+    plus_idx, minus_idx : ndarray, int
+        (n_x, n_lag) indices of psi(x + y) and psi(x - y), with the lag
+        axis already in FFT order (zero lag first)
+    valid : ndarray, bool
+        (n_x, n_lag) mask of the lags which stay inside the N samples
+    """
+    x_idx = np.linspace(0, N - 1, n_x).round().astype(int)
+    lags = np.fft.ifftshift(np.arange(n_lag) - n_lag // 2) * lag_step
+    plus_idx = x_idx[:, None] + lags[None, :]
+    minus_idx = x_idx[:, None] - lags[None, :]
+    valid = (plus_idx >= 0) & (plus_idx < N) & (minus_idx >= 0) & (minus_idx < N)
+    # The most negative lag of an even n_lag has no positive partner, drop it
+    # so that each row stays hermitian and its transform real
+    if n_lag % 2 == 0:
+        valid[:, n_lag // 2] = False
+    return np.clip(plus_idx, 0, N - 1), np.clip(minus_idx, 0, N - 1), valid
+
+
+def wigner_distribution(psi_x, table, husimi_sigma=None):
+    """
+    Wigner quasi-distribution W(x, p) of a wave function, computed as a
+    single batched FFT over the lag axis of a precomputed index table.
+    Parameters
+    ----------
+    psi_x : array_like, complex
+        Length-N wave function in the position representation
+    table : tuple
+        Gather table returned by wigner_index_table
+    husimi_sigma : tuple, optional
+        If given, (momentum, position) widths in table cells of a gaussian
+        smoothing W into the Husimi distribution, see husimi_sigma_cells
+
+    Returns
+    -------
+    W : ndarray, float
+        (n_lag, n_x) array, momentum along the rows and position along
+        the columns, ready for imshow(origin='lower')
+    """
+    plus_idx, minus_idx, valid = table
+    correlation = psi_x[plus_idx] * np.conj(psi_x[minus_idx])
+    correlation[~valid] = 0
+    W = np.fft.fftshift(np.fft.fft(correlation, axis=1).real, axes=1).T
+    if husimi_sigma:
+        W = ndimage.gaussian_filter(W, sigma=husimi_sigma)
+    return W
+
+
+def husimi_sigma_cells(N, n_x, n_lag, lag_step, dx, hbar=1):
+    """
+    Widths of the gaussian smoothing a Wigner table into a Husimi
+    distribution. The Husimi distribution is W convolved with the Wigner
+    function of a coherent state, sigma_x * sigma_p = hbar / 2, which makes
+    it positive. The widths are the same number of cells along both axes.
+    Parameters
+    ----------
+    N, n_x, n_lag, lag_step : int
+        Parameters of the table, see wigner_index_table
+    dx : float
+        Step of the wave function in position
+    hbar : float
+        Planck's constant (default = 1)
+
+    Returns
+    -------
+    sigma : tuple
+        (momentum, position) widths in table cells, in the axis order of
+        wigner_distribution
+    """
+    x_cell = (N - 1) * dx / (n_x - 1)
+    p_cell = np.pi * hbar / (n_lag * lag_step * dx)
+    sigma = np.sqrt(0.5 * hbar / (x_cell * p_cell))
+    return (sigma, sigma)
+
+
 ######################################################################
 # Create the animation
 
@@ -341,10 +473,33 @@ V_x_line.set_data(S.x, S.V_x)
 
 # Art stuff
 
-np_pixels = np.random.random([200, 200])
+# 'husimi' and 'wigner' show the phase-space distribution of psi(x), the
+# Husimi one is smoothed by a coherent state and positive (up to sampling
+# errors around 1e-3 of its peak) while the Wigner one has negative
+# interference regions. 'blur' is the old blurred cross of |psi(x)|
+art_mode = 'husimi'
+# Full N x N phase space is expensive, the decimated one stays real-time
+wigner_decimated = True
+wigner_lag_step = 3  # momentum range is +/- pi / (2 * lag_step * dx)
+
+art_size = 200 if art_mode == 'blur' else 256
+
+if art_mode != 'blur':
+    if wigner_decimated:
+        wigner_shape = (N, art_size, art_size, wigner_lag_step)
+    else:
+        wigner_shape = (N, N, N, 1)
+    wigner_table = wigner_index_table(*wigner_shape)
+    husimi_sigma = husimi_sigma_cells(*wigner_shape, dx=dx, hbar=hbar)
+
+np_pixels = np.random.random([art_size, art_size])
 
-ax3 = fig.add_subplot(313, xlim=(0, 199), ylim=(0, 199))
+ax3 = fig.add_subplot(313, xlim=(0, art_size - 1), ylim=(0, art_size - 1))
 pixels_array = ax3.imshow(np_pixels, cmap='inferno', interpolation='nearest', origin='lower', filternorm=False, resample=True, norm=None)
+if art_mode != 'blur':
+    # Signed W, negative regions of the Wigner distribution are blue
+    pixels_array.set_cmap('RdBu_r')
+    pixels_array.set_clim(-1, 1)
 ax3.set_title("Contemplez l'ART")
 
 
@@ -359,7 +514,7 @@ def init():
 
     psi_k_line.set_data([], [])
 
-    pixels_array.set_data(np.zeros([200, 200]))
+    pixels_array.set_data(np.zeros([art_size, art_size]))
 
     return (ax1_title, psi_x_line, V_x_line, center_line, psi_k_line, pixels_array,)
 
@@ -375,31 +530,41 @@ def animate(i):
 
     psi_k_line.set_data(S.k, abs(S.psi_k))
 
-    new_pixels = np.zeros([200, 200])
+    if art_mode == 'blur':
+        new_pixels = np.zeros([art_size, art_size])
 
-    psi_x_values = np.where(S.psi_x < 0, 0, 4 * abs(S.psi_x))
+        psi_x_values = np.where(S.psi_x < 0, 0, 4 * abs(S.psi_x))
 
-    resized_psi_x = resize(psi_x_values, (200,))
+        resized_psi_x = resize(psi_x_values, (art_size,))
 
-    new_pixels[100, :] = resized_psi_x * 100
+        new_pixels[art_size // 2, :] = resized_psi_x * 100
 
-    new_pixels = ndimage.gaussian_filter(new_pixels, sigma=10)
-    swapped_pixels = np.swapaxes(new_pixels, 0, 1)
-    new_pixels += swapped_pixels
-    new_pixels **= 4
+        new_pixels = ndimage.gaussian_filter(new_pixels, sigma=10)
+        swapped_pixels = np.swapaxes(new_pixels, 0, 1)
+        new_pixels += swapped_pixels
+        new_pixels **= 4
+    else:
+        W = wigner_distribution(S.psi_x, wigner_table,
+                                husimi_sigma if art_mode == 'husimi' else None)
+        if not wigner_decimated:
+            W = resize(W, (art_size, art_size))
+        # Signed square root, to keep the sign while lifting the faint parts
+        new_pixels = np.sign(W) * np.sqrt(abs(W) / abs(W).max())
 
     pixels_array.set_data(new_pixels)
 
     return (ax1_title, psi_x_line, V_x_line, center_line, psi_k_line, pixels_array,)
 
 
-# call the animator.  blit=True means only re-draw the parts that have changed.
-anim = animation.FuncAnimation(fig, animate, init_func=init,
-                               frames=frames, interval=1, blit=True)
+if __name__ == "__main__":
+    # call the animator.  blit=True means only re-draw the parts that have changed.
+    anim = animation.FuncAnimation(fig, animate, init_func=init,
+                                   frames=frames, interval=1, blit=True)
 
-# uncomment the following line to save the video in mp4 format.  This
-# requires either mencoder or ffmpeg to be installed on your system
+    # uncomment the following line to save the video in mp4 format.  This
+    # requires either mencoder or ffmpeg to be installed on your system.
+    # For long renders, prefer render_jobs.py which checkpoints and resumes
 
-# anim.save('schrodinger_barrier.mp4', fps=15, extra_args=['-vcodec', 'libx264'])
+    # anim.save('schrodinger_barrier.mp4', fps=15, extra_args=['-vcodec', 'libx264'])
 
-pl.show()
+    pl.show()
@@ -0,0 +1,313 @@
+"""
+ * Quantum Dance - resumable render jobs
+ * Renders the animation of main.py to video in checkpointed segments,
+ * so that a crash during a long render never means starting over from t0
+ *
+ * By Alexandre 'kidev' Poumaroux
+ *
+ * Copyright (C) 2022 Alexandre 'kidev' Poumaroux
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU Affero General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU Affero General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import time
+
+import numpy as np
+import matplotlib
+
+# Render off-screen, this must happen before main.py creates its figure
+matplotlib.use('Agg')
+
+from matplotlib import animation
+
+import main as qd
+
+
+JOB_TABLE = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    output TEXT NOT NULL,
+    work_dir TEXT NOT NULL,
+    t_max REAL NOT NULL,
+    fps INTEGER NOT NULL,
+    dpi INTEGER NOT NULL,
+    segment_frames INTEGER NOT NULL,
+    frames INTEGER NOT NULL,
+    done_segments INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    pid INTEGER,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+# Solver state right after main.py set it up, every new job starts from it
+INITIAL_STATE = qd.S.get_state()
+
+
+######################################################################
+# Job table
+
+def open_job_db(db_path):
+    """
+    Open (and create if needed) the SQLite job table.
+    Parameters
+    ----------
+    db_path : str
+        Path of the SQLite database shared by every runner on the machine
+    """
+    db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute(JOB_TABLE)
+    return db
+
+
+def add_job(db, output, t_max=qd.t_max, fps=15, dpi=100, segment_frames=100, work_dir=None):
+    """
+    Queue a new render job and return its id.
+    Parameters
+    ----------
+    output : str
+        Path of the final mp4 file
+    t_max : float
+        Simulated duration to render (default = t_max of main.py)
+    fps : int
+        Frame rate of the video (default = 15)
+    dpi : int
+        Resolution of the rendered figure (default = 100)
+    segment_frames : int
+        Number of frames encoded per segment, the solver is checkpointed
+        after each segment (default = 100)
+    work_dir : str, optional
+        Where segments and checkpoints are kept (default = output + '.parts')
+    """
+    assert segment_frames > 0
+    frames = int(t_max / float(qd.N_steps * qd.dt))
+    if work_dir is None:
+        work_dir = output + '.parts'
+    now = time.time()
+    cursor = db.execute(
+        "INSERT INTO jobs (output, work_dir, t_max, fps, dpi, segment_frames, frames, created, updated)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (os.path.abspath(output), os.path.abspath(work_dir), t_max, fps, dpi, segment_frames, frames, now, now))
+    return cursor.lastrowid
+
+
+def _pid_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def claim_job(db):
+    """
+    Atomically pick the next job to run: a queued one, or a running one
+    whose runner process died (that job is resumed from its checkpoint).
+    Returns None when there is nothing left to do.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute("SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY id").fetchall()
+        for row in rows:
+            if row['status'] == 'running' and _pid_alive(row['pid']):
+                continue
+            db.execute("UPDATE jobs SET status = 'running', pid = ?, updated = ? WHERE id = ?",
+                       (os.getpid(), time.time(), row['id']))
+            db.execute("COMMIT")
+            return db.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return None
+
+
+def _set_job(db, job_id, **fields):
+    fields['updated'] = time.time()
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+######################################################################
+# Checkpoints and segments
+
+def segment_path(work_dir, segment):
+    return os.path.join(work_dir, f"segment_{segment:05d}.mp4")
+
+
+def save_checkpoint(filename, segment):
+    """
+    Snapshot the solver and the RNG before rendering `segment`.
+    The snapshot is written to a temporary file and renamed, so a crash
+    never leaves a torn checkpoint behind.
+    """
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = np.random.get_state()
+    tmp_filename = filename + '.tmp.npz'
+    np.savez(tmp_filename,
+             segment=segment,
+             rng_name=rng_name,
+             rng_keys=rng_keys,
+             rng_pos=rng_pos,
+             rng_has_gauss=rng_has_gauss,
+             rng_gauss=rng_gauss,
+             **qd.S.get_state())
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename):
+    """
+    Restore the solver and the RNG from a checkpoint and return the index
+    of the first segment left to render.
+    """
+    with np.load(filename) as checkpoint:
+        qd.S.set_state(checkpoint)
+        np.random.set_state((str(checkpoint['rng_name']),
+                             checkpoint['rng_keys'],
+                             int(checkpoint['rng_pos']),
+                             int(checkpoint['rng_has_gauss']),
+                             float(checkpoint['rng_gauss'])))
+        return int(checkpoint['segment'])
+
+
+def render_segment(job, segment):
+    """
+    Step the solver through the frames of one segment and encode them
+    to their own mp4. The file only gets its final name once complete.
+    """
+    first_frame = segment * job['segment_frames']
+    last_frame = min(first_frame + job['segment_frames'], job['frames'])
+    final_path = segment_path(job['work_dir'], segment)
+    tmp_path = final_path[:-len('.mp4')] + '.tmp.mp4'
+
+    writer = animation.FFMpegWriter(fps=job['fps'], extra_args=['-vcodec', 'libx264'])
+    with writer.saving(qd.fig, tmp_path, job['dpi']):
+        for i in range(first_frame, last_frame):
+            qd.animate(i)
+            writer.grab_frame()
+    os.replace(tmp_path, final_path)
+
+
+def concat_segments(job, segments):
+    """
+    Join the finished segments into the final video without re-encoding.
+    """
+    list_path = os.path.join(job['work_dir'], 'segments.txt')
+    with open(list_path, 'w') as f:
+        for segment in range(segments):
+            f.write(f"file '{segment_path(job['work_dir'], segment)}'\n")
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                    '-i', list_path, '-c', 'copy', job['output']], check=True)
+
+
+def run_job(db, job):
+    """
+    Render a claimed job, resuming from its last checkpoint if any.
+    """
+    os.makedirs(job['work_dir'], exist_ok=True)
+    checkpoint_path = os.path.join(job['work_dir'], 'checkpoint.npz')
+    segments = -(-job['frames'] // job['segment_frames'])
+
+    if os.path.exists(checkpoint_path):
+        # The checkpoint, not the table, is the source of truth: it is
+        # only written once the segment before it is safely on disk
+        segment = load_checkpoint(checkpoint_path)
+        print(f"Job {job['id']}: resuming at segment {segment}/{segments} (t = {qd.S.t})")
+    else:
+        qd.S.set_state(INITIAL_STATE)
+        segment = 0
+        save_checkpoint(checkpoint_path, segment)
+        print(f"Job {job['id']}: starting {segments} segments of {job['segment_frames']} frames")
+
+    qd.init()
+    while segment < segments:
+        render_segment(job, segment)
+        segment += 1
+        save_checkpoint(checkpoint_path, segment)
+        _set_job(db, job['id'], done_segments=segment)
+        print(f"Job {job['id']}: segment {segment}/{segments} done (t = {qd.S.t})")
+
+    concat_segments(job, segments)
+    _set_job(db, job['id'], status='done', pid=None)
+    print(f"Job {job['id']}: saved {job['output']}")
+
+
+def run_queue(db):
+    """
+    Run jobs until the queue is empty. Several runners can share one
+    job table, each job is claimed by a single runner at a time.
+    """
+    while True:
+        job = claim_job(db)
+        if job is None:
+            print("No job left in the queue")
+            return
+        try:
+            run_job(db, job)
+        except Exception as e:
+            _set_job(db, job['id'], status='failed', pid=None, error=str(e))
+            print(f"Job {job['id']} failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue and run resumable Quantum Dance renders')
+    parser.add_argument('--db', default='render_jobs.sqlite3', help='Path of the job table')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help='Queue a new render job')
+    add_parser.add_argument('output', help='Output mp4 path')
+    add_parser.add_argument('--t-max', type=float, default=qd.t_max, help='Simulated duration to render')
+    add_parser.add_argument('--fps', type=int, default=15, help='Frame rate of the video')
+    add_parser.add_argument('--dpi', type=int, default=100, help='Resolution of the rendered figure')
+    add_parser.add_argument('--segment-frames', type=int, default=100,
+                            help='Frames per encoded segment, the solver is checkpointed after each one')
+    add_parser.add_argument('--work-dir', help='Where to keep segments and checkpoints')
+
+    commands.add_parser('run', help='Run (or resume) queued jobs until none is left')
+    commands.add_parser('list', help='Show the job table')
+
+    retry_parser = commands.add_parser('retry', help='Queue a failed job again, keeping its progress')
+    retry_parser.add_argument('job_id', type=int)
+
+    args = parser.parse_args()
+    db = open_job_db(args.db)
+
+    if args.command == 'add':
+        job_id = add_job(db, args.output, t_max=args.t_max, fps=args.fps, dpi=args.dpi,
+                         segment_frames=args.segment_frames, work_dir=args.work_dir)
+        print(f"Queued job {job_id}")
+    elif args.command == 'run':
+        run_queue(db)
+    elif args.command == 'list':
+        for row in db.execute("SELECT * FROM jobs ORDER BY id"):
+            segments = -(-row['frames'] // row['segment_frames'])
+            print(f"{row['id']:>4} {row['status']:<8} {row['done_segments']:>4}/{segments:<4} {row['output']}"
+                  + (f"  ({row['error']})" if row['error'] else ""))
+    elif args.command == 'retry':
+        _set_job(db, args.job_id, status='queued', pid=None, error=None)
+        print(f"Queued job {args.job_id} again")
+
+
+if __name__ == "__main__":
+    main()